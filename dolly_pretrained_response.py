@@ -24,26 +24,42 @@
 
 # MAGIC %md
 # MAGIC # Load Model & Tokenizer
+# MAGIC The model runs on the GPU when there is one. On a machine without a GPU it is loaded in float32 on the CPU instead of being offloaded to disk, and PyTorch uses `CPU_THREADS` threads per operation. See **CPU inference** below for the int8 quantization applied on the CPU.
 
 # COMMAND ----------
 
+import os
 import numpy as np
+import torch
+import weakref
+from typing import Dict, Iterator, List, Optional
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
+    Cache,
+    DynamicCache,
     PreTrainedModel,
     PreTrainedTokenizer
 )
 
 #tokenizer = AutoTokenizer.from_pretrained("databricks/dolly-v2-12b", padding_side="left")
 #model = AutoModelForCausalLM.from_pretrained("databricks/dolly-v2-12b", device_map="auto", trust_remote_code=True, offload_folder="offload")
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+CPU_THREADS = os.cpu_count()
+
 tokenizer = AutoTokenizer.from_pretrained("databricks/dolly-v2-7b", padding_side="left")
-model = AutoModelForCausalLM.from_pretrained("databricks/dolly-v2-7b", device_map="auto", trust_remote_code=True, offload_folder="offload")
+if DEVICE == "cuda":
+    model = AutoModelForCausalLM.from_pretrained("databricks/dolly-v2-7b", device_map="auto", trust_remote_code=True, offload_folder="offload")
+else:
+    torch.set_num_threads(CPU_THREADS)
+    model = AutoModelForCausalLM.from_pretrained("databricks/dolly-v2-7b", torch_dtype=torch.float32, trust_remote_code=True,
+                                                 low_cpu_mem_usage=True)
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC # Generate text
+# MAGIC Every prompt starts with the same preamble ("Below is an instruction that describes a task..."), which is a large part of the prompt for short instructions. `PromptPrefixCache` runs the preamble through the model once per loaded model and keeps its keys and values, so generation only has to process the instruction itself. In a batch, each prompt is padded between the shared preamble and its instruction, and the padding is masked out, so every prompt still sees exactly the preamble followed by its instruction. Pass `use_prefix_cache=False` to encode the full prompt every time.
 
 # COMMAND ----------
 
@@ -55,34 +71,237 @@ PROMPT_FORMAT = """Below is an instruction that describes a task. Write a respon
 ### Response:
 """
 
-def generate_response(instruction: str, *, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, 
-                      do_sample: bool = True, max_new_tokens: int = 256, top_p: float = 0.92, top_k: int = 0, **kwargs) -> str:
-    input_ids = tokenizer(PROMPT_FORMAT.format(instruction=instruction), return_tensors="pt").input_ids.to("cuda")
-
+class PromptPrefixCache:
+    def __init__(self, model: PreTrainedModel, tokenizer: PreTrainedTokenizer):
+        self.tokenizer = tokenizer
+        prefix, rest = PROMPT_FORMAT.split("{instruction}")
+        self.rest_format = "{instruction}" + rest
+        # the preamble ends with a newline, so tokenizing it separately from the rest gives the same tokens as the full prompt
+        self.device = model.device
+        self.prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids.to(self.device)
+        with torch.no_grad():
+            past_key_values = model(self.prefix_ids, use_cache=True).past_key_values
+        self.past_key_values = past_key_values.to_legacy_cache() if isinstance(past_key_values, Cache) else past_key_values
+
+    def inputs(self, instructions: List[str]) -> Dict:
+        batch_size = len(instructions)
+        # the tokenizer pads on the left, which puts the padding between the preamble and the instruction
+        rest = self.tokenizer([self.rest_format.format(instruction=instruction) for instruction in instructions],
+                              padding=True, return_tensors="pt").to(self.device)
+        prefix_ids = self.prefix_ids.expand(batch_size, -1)
+        # generate appends to the cache it is given, so every call gets its own copy of the preamble's keys and values
+        past_key_values = DynamicCache.from_legacy_cache(tuple(
+            tuple(tensor.expand(batch_size, *tensor.shape[1:]).clone() for tensor in layer) for layer in self.past_key_values))
+        return dict(input_ids=torch.cat([prefix_ids, rest.input_ids], dim=1),
+                    attention_mask=torch.cat([torch.ones_like(prefix_ids), rest.attention_mask], dim=1),
+                    past_key_values=past_key_values)
+
+
+_prefix_caches = weakref.WeakKeyDictionary()
+
+def prompt_inputs(instructions: List[str], *, model: PreTrainedModel, tokenizer: PreTrainedTokenizer,
+                  use_prefix_cache: bool = True) -> Dict:
+    if not use_prefix_cache:
+        prompts = [PROMPT_FORMAT.format(instruction=instruction) for instruction in instructions]
+        return dict(tokenizer(prompts, padding=True, return_tensors="pt").to(model.device))
+    prefix_cache = _prefix_caches.get(model)
+    if prefix_cache is None or prefix_cache.tokenizer is not tokenizer:
+        prefix_cache = _prefix_caches[model] = PromptPrefixCache(model, tokenizer)
+    return prefix_cache.inputs(instructions)
+
+
+def extract_response(gen_tokens, *, tokenizer: PreTrainedTokenizer) -> Optional[str]:
     # each of these is encoded to a single token
     response_key_token_id = tokenizer.encode("### Response:")[0]
     end_key_token_id = tokenizer.encode("### End")[0]
 
-    gen_tokens = model.generate(input_ids, pad_token_id=tokenizer.pad_token_id, eos_token_id=end_key_token_id,
-                                do_sample=do_sample, max_new_tokens=max_new_tokens, top_p=top_p, top_k=top_k, **kwargs)[0].cpu()
-
     # find where the response begins
     response_positions = np.where(gen_tokens == response_key_token_id)[0]
 
-    if len(response_positions) >= 0:
+    if len(response_positions) > 0:
         response_pos = response_positions[0]
-        
+
         # find where the response ends
         end_pos = None
-        end_positions = np.where(gen_tokens == end_key_token_id)[0]
+        end_positions = np.where(gen_tokens[response_pos + 1:] == end_key_token_id)[0]
         if len(end_positions) > 0:
-            end_pos = end_positions[0]
+            end_pos = response_pos + 1 + end_positions[0]
 
         return tokenizer.decode(gen_tokens[response_pos + 1 : end_pos]).strip()
 
     return None
 
 
+def generate_response(instruction: str, *, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, 
+                      do_sample: bool = True, max_new_tokens: int = 256, top_p: float = 0.92, top_k: int = 0,
+                      use_prefix_cache: bool = True, **kwargs) -> str:
+    inputs = prompt_inputs([instruction], model=model, tokenizer=tokenizer, use_prefix_cache=use_prefix_cache)
+
+    end_key_token_id = tokenizer.encode("### End")[0]
+
+    gen_tokens = model.generate(**inputs, pad_token_id=tokenizer.pad_token_id, eos_token_id=end_key_token_id,
+                                do_sample=do_sample, max_new_tokens=max_new_tokens, top_p=top_p, top_k=top_k, **kwargs)[0].cpu()
+
+    return extract_response(gen_tokens, tokenizer=tokenizer)
+
+
+def generate_responses(instructions: List[str], *, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, batch_size: int = 8,
+                       do_sample: bool = True, max_new_tokens: int = 256, top_p: float = 0.92, top_k: int = 0,
+                       use_prefix_cache: bool = True, **kwargs) -> List[Optional[str]]:
+    prompts = [PROMPT_FORMAT.format(instruction=instruction) for instruction in instructions]
+    end_key_token_id = tokenizer.encode("### End")[0]
+
+    # batch prompts of similar length together, so little of each batch is padding
+    prompt_lengths = [len(input_ids) for input_ids in tokenizer(prompts).input_ids]
+    order = sorted(range(len(prompts)), key=lambda i: prompt_lengths[i])
+
+    responses = [None] * len(prompts)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        # the tokenizer pads on the left, so every prompt ends right where generation starts
+        inputs = prompt_inputs([instructions[i] for i in batch], model=model, tokenizer=tokenizer, use_prefix_cache=use_prefix_cache)
+        gen_tokens = model.generate(**inputs, pad_token_id=tokenizer.pad_token_id,
+                                    eos_token_id=end_key_token_id, do_sample=do_sample, max_new_tokens=max_new_tokens,
+                                    top_p=top_p, top_k=top_k, **kwargs).cpu()
+        for i, row_tokens in zip(batch, gen_tokens):
+            responses[i] = extract_response(row_tokens, tokenizer=tokenizer)
+
+    return responses
+
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Streaming generation
+# MAGIC `stream_response` yields the response piece by piece while it is being generated, instead of returning it when generation has finished, so the first words appear almost immediately. The streamer only emits text that forms complete tokens and words, and generation stops at the `### End` token. If you stop iterating early, generation is stopped as well.
+
+# COMMAND ----------
+
+import threading
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+class StopOnEvent(StoppingCriteria):
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
+
+
+def stream_response(instruction: str, *, model: PreTrainedModel, tokenizer: PreTrainedTokenizer,
+                    do_sample: bool = True, max_new_tokens: int = 256, top_p: float = 0.92, top_k: int = 0,
+                    use_prefix_cache: bool = True, **kwargs) -> Iterator[str]:
+    inputs = prompt_inputs([instruction], model=model, tokenizer=tokenizer, use_prefix_cache=use_prefix_cache)
+    end_key_token_id = tokenizer.encode("### End")[0]
+
+    # skip_prompt drops the prompt, which ends with "### Response:", and skip_special_tokens drops the "### End" token
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stop = threading.Event()
+    errors = []
+
+    def generate():
+        try:
+            model.generate(**inputs, pad_token_id=tokenizer.pad_token_id, eos_token_id=end_key_token_id, streamer=streamer,
+                           stopping_criteria=StoppingCriteriaList([StopOnEvent(stop)]), do_sample=do_sample,
+                           max_new_tokens=max_new_tokens, top_p=top_p, top_k=top_k, **kwargs)
+        except Exception as e:
+            # unblock the loop below, which would otherwise wait for text forever
+            errors.append(e)
+            streamer.end()
+
+    generation = threading.Thread(target=generate, daemon=True)
+    generation.start()
+
+    try:
+        started = False
+        for text in streamer:
+            # match generate_response, which strips the leading whitespace of the response
+            if not started:
+                text = text.lstrip()
+                started = bool(text)
+            if text:
+                yield text
+    finally:
+        stop.set()
+        generation.join()
+    if errors:
+        raise errors[0]
+
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # CPU inference
+# MAGIC On the CPU, `quantize_for_cpu` replaces the weights of every linear layer with int8 weights (PyTorch dynamic quantization), which makes generation considerably faster and the model about a quarter of the size. Before quantizing, the float32 model generates greedy responses to the fixed `QUALITY_PROMPTS`. Afterwards, `compare_to_reference` reports how far the int8 model is from those responses:
+# MAGIC - `exact_match`: the fraction of prompts for which the int8 model generates the same greedy response
+# MAGIC - `mean_abs_logprob_diff` and `max_abs_logprob_diff`: the difference in log-probability of each reference response token, with both models reading the same reference text
+# MAGIC - `top1_agreement`: the fraction of those positions at which both models rank the same next token first
+# MAGIC
+# MAGIC The comparison is made before quantizing the model in place, so the float32 and int8 models never have to fit in memory together.
+
+# COMMAND ----------
+
+QUALITY_PROMPTS = [
+    "Write a tweet announcing Dolly, a large language model from Databricks.",
+    "Is a hotdog a sandwich?",
+    "explain the python concept of __init__ in simple terms",
+    "What is the difference between a data lake and a data warehouse?",
+    "Give three tips for writing readable SQL.",
+]
+
+def quantize_for_cpu(model: PreTrainedModel) -> PreTrainedModel:
+    torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    # the cached preamble keys and values were computed with the float32 weights
+    _prefix_caches.pop(model, None)
+    return model
+
+
+def response_logprobs(instruction: str, response_ids: List[int], *, model: PreTrainedModel, tokenizer: PreTrainedTokenizer):
+    prompt_ids = tokenizer(PROMPT_FORMAT.format(instruction=instruction)).input_ids
+    input_ids = torch.tensor([prompt_ids + response_ids], device=model.device)
+    with torch.no_grad():
+        # the logits at each position predict the token after it
+        logits = model(input_ids).logits[0, len(prompt_ids) - 1 : -1].float()
+    logprobs = torch.log_softmax(logits, dim=-1)
+    targets = torch.tensor(response_ids, dtype=torch.long, device=model.device)
+    return logprobs.gather(1, targets[:, None])[:, 0].cpu().numpy(), logits.argmax(dim=-1).cpu().numpy()
+
+
+def reference_outputs(instructions: List[str], *, model: PreTrainedModel, tokenizer: PreTrainedTokenizer,
+                      max_new_tokens: int = 64) -> List[Dict]:
+    responses = generate_responses(instructions, model=model, tokenizer=tokenizer, do_sample=False, max_new_tokens=max_new_tokens)
+    reference = []
+    for instruction, response in zip(instructions, responses):
+        response_ids = tokenizer(response or "").input_ids
+        logprobs, top1 = response_logprobs(instruction, response_ids, model=model, tokenizer=tokenizer)
+        reference.append(dict(instruction=instruction, response=response, response_ids=response_ids, logprobs=logprobs, top1=top1))
+    return reference
+
+
+def compare_to_reference(reference: List[Dict], *, model: PreTrainedModel, tokenizer: PreTrainedTokenizer,
+                         max_new_tokens: int = 64) -> Dict[str, float]:
+    instructions = [row["instruction"] for row in reference]
+    responses = generate_responses(instructions, model=model, tokenizer=tokenizer, do_sample=False, max_new_tokens=max_new_tokens)
+    logprob_diffs, top1_matches = [], []
+    for row in reference:
+        logprobs, top1 = response_logprobs(row["instruction"], row["response_ids"], model=model, tokenizer=tokenizer)
+        logprob_diffs.append(np.abs(logprobs - row["logprobs"]))
+        top1_matches.append(top1 == row["top1"])
+    logprob_diffs, top1_matches = np.concatenate(logprob_diffs), np.concatenate(top1_matches)
+    return dict(
+        exact_match=float(np.mean([response == row["response"] for response, row in zip(responses, reference)])),
+        mean_abs_logprob_diff=float(logprob_diffs.mean()) if len(logprob_diffs) else 0.0,
+        max_abs_logprob_diff=float(logprob_diffs.max()) if len(logprob_diffs) else 0.0,
+        top1_agreement=float(top1_matches.mean()) if len(top1_matches) else 1.0,
+    )
+
+# COMMAND ----------
+
+if DEVICE == "cpu":
+    fp32_reference = reference_outputs(QUALITY_PROMPTS, model=model, tokenizer=tokenizer)
+    model = quantize_for_cpu(model)
+    print(compare_to_reference(fp32_reference, model=model, tokenizer=tokenizer))
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -104,4 +323,28 @@ generate_response("explain the python concept of __init__ in simple terms", mode
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC # Batched generation
+# MAGIC `generate_responses` takes a list of instructions and generates their responses in batches of `batch_size`, which keeps the GPU much busier than one `generate` call per instruction. Instructions with similar prompt lengths are batched together to keep padding to a minimum, and the responses are returned in the order of the instructions.
+
+# COMMAND ----------
+
+generate_responses([
+    "Write a tweet announcing Dolly, a large language model from Databricks.",
+    "Is a hotdog a sandwich?",
+    "explain the python concept of __init__ in simple terms",
+], model=model, tokenizer=tokenizer)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC # Streaming output
+
+# COMMAND ----------
+
+for text in stream_response("explain the python concept of __init__ in simple terms", model=model, tokenizer=tokenizer):
+    print(text, end="", flush=True)
+
+# COMMAND ----------
+
 
@@ -50,6 +50,12 @@ display(dbutils.fs.ls('dbfs:/databricks-datasets/wine-quality/'))
 
 # COMMAND ----------
 
+# The two CSV files of the wine quality data set
+white_wine_path = '/dbfs/databricks-datasets/wine-quality/winequality-white.csv'
+red_wine_path = '/dbfs/databricks-datasets/wine-quality/winequality-red.csv'
+
+# COMMAND ----------
+
 # MAGIC %md 
 # MAGIC 
 # MAGIC   **Note**: if you don't have to /dbfs/databricks-datasets/, you can load the dataset from the UI. Uncomment and run the cell below after uploading the file.
@@ -62,43 +68,86 @@ display(dbutils.fs.ls('dbfs:/databricks-datasets/wine-quality/'))
 # MAGIC 
 # MAGIC 1. Click *Next*. Some auto-generated code to load the data appears. Select *pandas*, and copy the example code. 
 # MAGIC 
-# MAGIC 1. Create a new cell, then paste in the sample code. It will look similar to the code shown in the following cell. Make these changes:
-# MAGIC   - Pass `sep=';'` to `pd.read_csv`
-# MAGIC   - Change the variable names from `df1` and `df2` to `white_wine` and `red_wine`, as shown in the following cell.
+# MAGIC 1. Copy the paths of the two uploaded files from the sample code into `white_wine_path` and `red_wine_path`, as shown in the following cell. The files are read with `pd.read_csv(path, sep=';')` when the data is loaded below.
 
 # COMMAND ----------
 
 # # If you do not have access to the sample datasets, follow the instructions in the previous cell to upload the data from your local machine.
-# # The generated code, including the required edits described in the previous cell, is shown here for reference.
-
-# import pandas as pd
+# # The paths from the generated code are shown here for reference.
 
 # # In the following lines, replace <username@...> with your username.
-# white_wine = pd.read_csv("/dbfs/FileStore/shared_uploads/<username@...>/winequality_white.csv", sep=';')
-# red_wine = pd.read_csv("/dbfs/FileStore/shared_uploads/<username@....>/winequality_red.csv", sep=';')
+# white_wine_path = "/dbfs/FileStore/shared_uploads/<username@...>/winequality_white.csv"
+# red_wine_path = "/dbfs/FileStore/shared_uploads/<username@....>/winequality_red.csv"
 
 # COMMAND ----------
 
-#display the data in the white wine dataset
-white_wine
+# MAGIC %md `load_wine_data` merges the two files into a single dataset, with a new binary feature "is_red" that indicates whether the wine is red or white, and removes the spaces from the column names.
+# MAGIC 
+# MAGIC Parsing the CSV text and materializing every column as float64 is cheap for this dataset but dominates startup on larger extracts. `load_wine_data` therefore caches the merged data as an uncompressed Feather (Arrow IPC) file named after a hash of the source files' contents and `WINE_DATA_TRANSFORM_VERSION`. Later runs memory-map the cached file instead of parsing the CSVs again. The text is re-parsed only when a source file changes or the version is bumped after a change to how the frame is built. The columns of the returned DataFrame are backed by the memory-mapped file and are read-only: replacing a column, as `data.quality = ...` does below, works, but writing into one in place (for example `data.loc[0, 'alcohol'] = 5`) raises an error. Call `data.copy()` first if you need to do that.
+# MAGIC 
+# MAGIC The cached columns are downcast: measurements are stored as float32, while `quality` and the `is_red` indicator are stored as int8. `is_red` stays an integer rather than a pandas category, because xgboost's `DMatrix` rejects category columns unless categorical support is enabled. Models are still logged with float64/int64 input signatures (see `widen_dtypes`), so JSON clients that send doubles keep working.
 
 # COMMAND ----------
 
-red_wine
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+def _file_digest(paths):
+  digest = hashlib.sha256()
+  for path in paths:
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        digest.update(block)
+  return digest.hexdigest()[:16]
+
+def downcast_dtypes(frame):
+  frame = frame.astype({col: np.float32 for col in frame.select_dtypes('float').columns})
+  for col in frame.select_dtypes('integer').columns:
+    frame[col] = pd.to_numeric(frame[col], downcast='integer')
+  return frame
+
+def widen_dtypes(frame):
+  # Inverse of downcast_dtypes, used for model signatures: MLflow only accepts inputs that safely cast to the schema type
+  return frame.astype({col: np.float64 if frame[col].dtype.kind == 'f' else np.int64
+                       for col in frame.select_dtypes('number').columns})
+
+# Bump whenever load_wine_data or downcast_dtypes changes the cached frame, so old cache files are not reused
+WINE_DATA_TRANSFORM_VERSION = 1
+
+def load_wine_data(white_path, red_path, cache_dir='/dbfs/tmp/wine_quality_cache'):
+  cache_name = f'wine_quality_v{WINE_DATA_TRANSFORM_VERSION}_{_file_digest([white_path, red_path])}.feather'
+  cache_path = os.path.join(cache_dir, cache_name)
+  if not os.path.exists(cache_path):
+    white_wine = pd.read_csv(white_path, sep=';')
+    red_wine = pd.read_csv(red_path, sep=';')
+    red_wine['is_red'] = 1
+    white_wine['is_red'] = 0
+    data = pd.concat([red_wine, white_wine], axis=0, ignore_index=True)
+    data.rename(columns=lambda x: x.replace(' ', '_'), inplace=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write under a temporary name first, so a concurrent or interrupted run never reads a partial file
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    feather.write_feather(downcast_dtypes(data), tmp_path, compression='uncompressed')
+    os.replace(tmp_path, cache_path)
+  # split_blocks avoids consolidating the memory-mapped columns into one newly allocated 2D block.
+  # The columns stay backed by the read-only mapping, so they cannot be modified in place.
+  return feather.read_table(cache_path, memory_map=True).to_pandas(split_blocks=True)
+
+# COMMAND ----------
+
+data = load_wine_data(white_wine_path, red_wine_path)
 
 # COMMAND ----------
 
-# MAGIC %md Merge the two DataFrames into a single dataset, with a new binary feature "is_red" that indicates whether the wine is red or white.
+#display the data in the white wine dataset
+data[data.is_red == 0]
 
 # COMMAND ----------
 
-red_wine['is_red'] = 1
-white_wine['is_red'] = 0
-
-data = pd.concat([red_wine, white_wine], axis=0)
-
-# Remove spaces from column names
-data.rename(columns=lambda x: x.replace(' ', '_'), inplace=True)
+data[data.is_red == 1]
 
 # COMMAND ----------
 
@@ -133,23 +182,110 @@ data.quality = high_quality
 # COMMAND ----------
 
 # MAGIC %md Box plots are useful in noticing correlations between features and a binary label.
+# MAGIC 
+# MAGIC Drawing each box plot with `sns.boxplot` recomputes the quantiles over the full dataset for every column. Instead, `box_stats` computes the quartiles, whiskers and outliers of all numeric columns, split by label, in one vectorized pass, and the plot grid is drawn from those summaries with matplotlib's `bxp`. Whiskers extend to the most extreme values within 1.5 times the interquartile range, as in `sns.boxplot`. At most `max_fliers` outliers are kept per box for drawing, the ones farthest from the fences; `n_fliers` holds the full count.
+# MAGIC 
+# MAGIC For data that doesn't fit in driver memory, `spark_box_stats` computes the same summaries on a Spark DataFrame. It uses Spark's `percentile_approx` quantile sketch, and `accuracy` bounds the sketch size. Like `box_stats`, it keeps the `max_fliers` outliers farthest from the fences in each box.
 
 # COMMAND ----------
 
 import matplotlib.pyplot as plt
 
-dims = (3, 4)
-
-f, axes = plt.subplots(dims[0], dims[1], figsize=(25, 15))
-axis_i, axis_j = 0, 0
-for col in data.columns:
-  if col == 'is_red' or col == 'quality':
-    continue # Box plots cannot be used on indicator variables
-  sns.boxplot(x=high_quality, y=data[col], ax=axes[axis_i, axis_j])
-  axis_j += 1
-  if axis_j == dims[1]:
-    axis_i += 1
-    axis_j = 0
+def box_stats(frame, by, columns, whis=1.5, max_fliers=200):
+  values = frame[columns].to_numpy(dtype=np.float64)
+  codes, groups = pd.factorize(frame[by], sort=True)
+  quartiles = frame[columns].groupby(codes).quantile([0.25, 0.5, 0.75])
+  q1, med, q3 = (quartiles.xs(q, level=1).to_numpy() for q in (0.25, 0.5, 0.75))
+  # Index the per-group fences by each row's group code to compare every value against its own group's fences at once
+  iqr = q3 - q1
+  lower_fence, upper_fence = (q1 - whis * iqr)[codes], (q3 + whis * iqr)[codes]
+  inside = (values >= lower_fence) & (values <= upper_fence)
+  whislo = pd.DataFrame(np.where(inside, values, np.nan)).groupby(codes).min().to_numpy()
+  whishi = pd.DataFrame(np.where(inside, values, np.nan)).groupby(codes).max().to_numpy()
+  outside = ~inside & ~np.isnan(values)
+  # Outliers are rare, so only the rows that contain one are scanned per box
+  outlier_rows = np.flatnonzero(outside.any(axis=1))
+  outlier_codes, outlier_values, outlier_mask = codes[outlier_rows], values[outlier_rows], outside[outlier_rows]
+  outlier_distance = np.maximum(lower_fence[outlier_rows] - outlier_values, outlier_values - upper_fence[outlier_rows])
+
+  def fliers(g, j):
+    # Farthest from the fences first, so _box keeps the same max_fliers outliers as spark_box_stats
+    selected = outlier_mask[:, j] & (outlier_codes == g)
+    return outlier_values[selected, j][np.argsort(-outlier_distance[selected, j], kind='stable')]
+
+  return {
+    col: [_box(label, q1[g, j], med[g, j], q3[g, j], whislo[g, j], whishi[g, j], fliers(g, j), max_fliers)
+          for g, label in enumerate(groups)]
+    for j, col in enumerate(columns)
+  }
+
+def spark_box_stats(spark_df, by, columns, whis=1.5, max_fliers=200, accuracy=10000):
+  from functools import reduce
+  from pyspark.sql import Window, functions as F
+
+  # First pass: approximate quartiles for every column and group
+  rows = spark_df.groupBy(by).agg(*[F.percentile_approx(col, [0.25, 0.5, 0.75], accuracy).alias(col) for col in columns]).collect()
+  quartiles = {row[by]: {col: row[col] for col in columns} for row in rows}
+  fence_rows = []
+  for group, group_quartiles in quartiles.items():
+    fence_row = [group]
+    for col in columns:
+      q1, _, q3 = group_quartiles[col]
+      fence_row += [q1 - whis * (q3 - q1), q3 + whis * (q3 - q1)]
+    fence_rows.append(fence_row)
+  fences = spark_df.sparkSession.createDataFrame(
+    fence_rows, [by] + [f'{col}_{bound}' for col in columns for bound in ('lower_fence', 'upper_fence')])
+  # Second pass: whiskers and outlier counts
+  fenced = spark_df.join(F.broadcast(fences), on=by)
+  aggregations, outliers = [], []
+  for col in columns:
+    inside = F.col(col).between(F.col(f'{col}_lower_fence'), F.col(f'{col}_upper_fence'))
+    aggregations += [
+      F.min(F.when(inside, F.col(col))).alias(f'{col}_whislo'),
+      F.max(F.when(inside, F.col(col))).alias(f'{col}_whishi'),
+      F.count(F.when(~inside, F.col(col))).alias(f'{col}_n_fliers'),
+    ]
+    distance = F.greatest(F.col(f'{col}_lower_fence') - F.col(col), F.col(col) - F.col(f'{col}_upper_fence'))
+    outliers.append(fenced.where(~inside).select(by, F.lit(col).alias('column'), F.col(col).cast('double').alias('value'),
+                                                 distance.cast('double').alias('distance')))
+  summaries = {row[by]: row for row in fenced.groupBy(by).agg(*aggregations).collect()}
+  # Third pass: the max_fliers most extreme outliers of each box. Ranking them with a window keeps at most
+  # max_fliers values per box on the driver, instead of first collecting every outlier into one array.
+  rank = F.row_number().over(Window.partitionBy(by, 'column').orderBy(F.col('distance').desc()))
+  fliers = {}
+  for row in reduce(lambda a, b: a.unionByName(b), outliers).withColumn('rank', rank).where(F.col('rank') <= max_fliers).collect():
+    fliers.setdefault((row[by], row['column']), []).append(row['value'])
+  groups = sorted(quartiles)
+  stats = {}
+  for col in columns:
+    stats[col] = []
+    for group in groups:
+      q, row = quartiles[group][col], summaries[group]
+      box = _box(group, q[0], q[1], q[2], row[f'{col}_whislo'], row[f'{col}_whishi'],
+                 np.array(fliers.get((group, col), []), dtype=np.float64), max_fliers)
+      box['n_fliers'] = row[f'{col}_n_fliers']
+      stats[col].append(box)
+  return stats
+
+def _box(label, q1, med, q3, whislo, whishi, fliers, max_fliers):
+  # Keys follow matplotlib's Axes.bxp, which draws a box plot from precomputed statistics
+  return {'label': str(label), 'q1': q1, 'med': med, 'q3': q3, 'whislo': whislo, 'whishi': whishi,
+          'fliers': fliers[:max_fliers], 'n_fliers': len(fliers)}
+
+def plot_box_stats(stats, dims=(3, 4), figsize=(25, 15)):
+  f, axes = plt.subplots(dims[0], dims[1], figsize=figsize)
+  for ax, (col, boxes) in zip(axes.flat, stats.items()):
+    ax.bxp(boxes)
+    ax.set_ylabel(col)
+  for ax in axes.flat[len(stats):]:
+    ax.set_visible(False)
+  return f
+
+# COMMAND ----------
+
+# Box plots cannot be used on indicator variables
+box_columns = [col for col in data.columns if col not in ('is_red', 'quality')]
+plot_box_stats(box_stats(data, 'quality', box_columns), dims=(3, 4))
 
 # COMMAND ----------
 
@@ -191,6 +327,194 @@ y_test = test.quality
 
 # COMMAND ----------
 
+# MAGIC %md #### Compiled tree-ensemble inference
+# MAGIC 
+# MAGIC For single rows and small batches, most of the time spent in `predict_proba` is scikit-learn's per-tree Python dispatch, not the trees themselves. `CompiledTreeEnsemble` flattens every tree of a random forest or an xgboost booster into a few contiguous NumPy arrays (split feature, threshold, left and right child, leaf value) and walks all trees for a whole batch at once, one tree level per step. Its outputs match `predict_proba(X)[:, 1]` and `booster.predict` to within float tolerance.
+
+# COMMAND ----------
+
+import json
+import numpy as np
+
+class CompiledTreeEnsemble:
+  # Leaves point to themselves, so once a row reaches a leaf the remaining traversal steps leave it in place.
+  # strict selects the split rule: xgboost sends x < threshold left, scikit-learn sends x <= threshold left.
+  def __init__(self, feature, threshold, left, right, missing_left, leaf_value, roots,
+               strict=False, base_margin=0.0, scale=1.0, link='identity', feature_names=None, chunk_size=65536):
+    self.feature = feature
+    self.threshold = threshold
+    self.left = left
+    self.right = right
+    self.missing_left = missing_left
+    self.leaf_value = leaf_value
+    self.roots = roots
+    self.strict = strict
+    self.base_margin = base_margin
+    self.scale = scale
+    self.link = link
+    self.feature_names = feature_names
+    self.chunk_size = chunk_size
+    self.max_depth = self._max_depth()
+
+  @classmethod
+  def from_sklearn(cls, forest):
+    features, thresholds, lefts, rights, leaf_values, roots = [], [], [], [], [], []
+    offset = 0
+    for estimator in forest.estimators_:
+      tree = estimator.tree_
+      nodes = np.arange(tree.node_count)
+      is_leaf = tree.children_left == -1
+      # Each tree predicts the class-1 fraction of its leaf, and the forest averages the trees
+      value = tree.value[:, 0, :]
+      features.append(np.where(is_leaf, 0, tree.feature))
+      thresholds.append(tree.threshold)
+      lefts.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+      rights.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+      leaf_values.append(value[:, 1] / value.sum(axis=1))
+      roots.append(offset)
+      offset += tree.node_count
+    left = np.concatenate(lefts)
+    feature_names = getattr(forest, 'feature_names_in_', None)
+    return cls(np.concatenate(features), np.concatenate(thresholds), left, np.concatenate(rights),
+               np.zeros(len(left), dtype=bool), np.concatenate(leaf_values), np.array(roots),
+               strict=False, scale=1 / len(roots), link='identity',
+               feature_names=None if feature_names is None else list(feature_names))
+
+  @classmethod
+  def from_xgboost(cls, booster, iteration_range=None):
+    trees = booster.trees_to_dataframe()
+    if iteration_range is not None:
+      trees = trees[(trees.Tree >= iteration_range[0]) & (trees.Tree < iteration_range[1])].reset_index(drop=True)
+    feature_names = booster.feature_names or [f'f{i}' for i in range(booster.num_features())]
+    node_index = pd.Series(np.arange(len(trees)), index=trees.ID)
+    nodes = np.arange(len(trees))
+    is_leaf = (trees.Feature == 'Leaf').to_numpy()
+
+    def child(column):
+      return np.where(is_leaf, nodes, trees[column].map(node_index).fillna(-1).to_numpy(dtype=np.int64))
+
+    config = json.loads(booster.save_config())
+    # Recent xgboost versions write base_score as a one-element list, e.g. "[5E-1]"
+    base_score = float(config['learner']['learner_model_param']['base_score'].strip('[]'))
+    objective = config['learner']['objective']['name']
+    link = 'logistic' if objective == 'binary:logistic' else 'identity'
+    base_margin = np.log(base_score / (1 - base_score)) if link == 'logistic' else base_score
+    return cls(trees.Feature.map({name: i for i, name in enumerate(feature_names)}).fillna(0).to_numpy(dtype=np.int64),
+               trees.Split.fillna(np.inf).to_numpy(dtype=np.float32), child('Yes'), child('No'),
+               (trees.Missing == trees.Yes).to_numpy(), np.where(is_leaf, trees.Gain, 0.0),
+               nodes[trees.Node.to_numpy() == 0], strict=True, base_margin=base_margin, scale=1.0, link=link,
+               feature_names=list(feature_names))
+
+  def predict(self, model_input) -> np.ndarray:
+    if isinstance(model_input, pd.DataFrame) and self.feature_names is not None:
+      model_input = model_input[self.feature_names]
+    # Both libraries compare float32 feature values against the split thresholds
+    X = np.asarray(model_input, dtype=np.float32)
+    # Bound the (rows x trees) index matrices so large batches don't blow up memory
+    rows_per_chunk = max(1, self.chunk_size // len(self.roots))
+    margin = np.concatenate([self._margin(X[start:start + rows_per_chunk])
+                             for start in range(0, len(X), rows_per_chunk)]) if len(X) else np.empty(0)
+    margin = self.base_margin + self.scale * margin
+    if self.link == 'logistic':
+      return 1 / (1 + np.exp(-margin))
+    return margin
+
+  def _margin(self, X):
+    rows = np.arange(len(X))[:, None]
+    nodes = np.broadcast_to(self.roots, (len(X), len(self.roots))).copy()
+    for _ in range(self.max_depth):
+      values = X[rows, self.feature[nodes]]
+      thresholds = self.threshold[nodes]
+      go_left = values < thresholds if self.strict else values <= thresholds
+      go_left = np.where(np.isnan(values), self.missing_left[nodes], go_left)
+      nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+    # Accumulate in float64 even when the leaf values are stored as float32
+    return self.leaf_value[nodes].sum(axis=1, dtype=np.float64)
+
+  def compacted(self):
+    # Returns an equivalent ensemble that stores float32 values and narrow integer indices, with redundant subtrees removed
+    is_leaf = self.left == np.arange(len(self.left))
+    leaf_value = np.where(is_leaf, self.leaf_value, 0).astype(np.float32)
+    left, right = self.left.copy(), self.right.copy()
+    # Work from the deepest level up, so a split whose children are identical leaves, possibly only after
+    # collapsing their own subtrees, becomes a leaf itself
+    for level in reversed(self._levels(left, right, is_leaf)):
+      nodes = level[~is_leaf[level]]
+      same = is_leaf[left[nodes]] & is_leaf[right[nodes]] & (leaf_value[left[nodes]] == leaf_value[right[nodes]])
+      collapsed = nodes[same]
+      leaf_value[collapsed] = leaf_value[left[collapsed]]
+      is_leaf[collapsed] = True
+      left[collapsed] = right[collapsed] = collapsed
+    # Keep only the nodes still reachable from a root, numbered level by level
+    keep = np.concatenate(self._levels(left, right, is_leaf))
+    new_index = np.zeros(len(left), dtype=np.int32)
+    new_index[keep] = np.arange(len(keep), dtype=np.int32)
+    # Round each threshold towards the side that keeps every float32 comparison exactly as before:
+    # down for x <= threshold, up for x < threshold
+    threshold = self.threshold[keep]
+    threshold32 = threshold.astype(np.float32)
+    if self.strict:
+      threshold32 = np.where(threshold32 < threshold, np.nextafter(threshold32, np.float32(np.inf)), threshold32)
+    else:
+      threshold32 = np.where(threshold32 > threshold, np.nextafter(threshold32, np.float32(-np.inf)), threshold32)
+    feature_dtype = np.int16 if self.feature.max(initial=0) < np.iinfo(np.int16).max else np.int32
+    return CompiledTreeEnsemble(
+      np.where(is_leaf, 0, self.feature)[keep].astype(feature_dtype), threshold32,
+      new_index[left[keep]], new_index[right[keep]], self.missing_left[keep], leaf_value[keep], new_index[self.roots],
+      strict=self.strict, base_margin=self.base_margin, scale=self.scale, link=self.link,
+      feature_names=self.feature_names, chunk_size=self.chunk_size)
+
+  def save(self, path):
+    with open(path, 'wb') as f:
+      np.savez(f, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+               missing_left=self.missing_left, leaf_value=self.leaf_value, roots=self.roots,
+               metadata=np.array(json.dumps({
+                 'strict': self.strict, 'base_margin': float(self.base_margin), 'scale': float(self.scale),
+                 'link': self.link, 'feature_names': self.feature_names})))
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path) as arrays:
+      metadata = json.loads(str(arrays['metadata']))
+      return cls(arrays['feature'], arrays['threshold'], arrays['left'], arrays['right'], arrays['missing_left'],
+                 arrays['leaf_value'], arrays['roots'], **metadata)
+
+  def _max_depth(self):
+    return len(self._levels(self.left, self.right, self.left == np.arange(len(self.left)))) - 1
+
+  def _levels(self, left, right, is_leaf):
+    # Node ids reachable from the roots, grouped by depth
+    levels = [np.asarray(self.roots)]
+    while True:
+      internal = levels[-1][~is_leaf[levels[-1]]]
+      if not len(internal):
+        return levels
+      levels.append(np.concatenate([left[internal], right[internal]]))
+
+# COMMAND ----------
+
+# MAGIC %md #### Inferring model signatures from a sample
+# MAGIC 
+# MAGIC A model signature only describes column names and types, so scoring the whole training set just to infer it is wasted work, and the sweep would pay for it in every trial. `sample_signature` infers the signature from the first `sample_rows` rows, or from predictions that have already been computed. It then checks the inferred input schema against the schema of the full input. Numeric columns are typed from their dtype alone, so the check reads no data and makes no predictions.
+
+# COMMAND ----------
+
+from mlflow.models.signature import infer_signature
+
+def sample_signature(model_input, predict_fn=None, model_output=None, sample_rows=100):
+  sample = model_input.head(sample_rows)
+  if model_output is None:
+    model_output = predict_fn(sample)
+  signature = infer_signature(widen_dtypes(sample), np.asarray(model_output)[:sample_rows])
+  # Only non-numeric columns need their values inspected to infer the full schema
+  all_numeric = len(model_input.select_dtypes('number').columns) == len(model_input.columns)
+  full_inputs = infer_signature(widen_dtypes(model_input.iloc[:0] if all_numeric else model_input)).inputs
+  if signature.inputs != full_inputs:
+    raise Exception(f'Sampled input schema {signature.inputs} does not match the full input schema {full_inputs}')
+  return signature
+
+# COMMAND ----------
+
 import mlflow
 import mlflow.pyfunc
 import mlflow.sklearn
@@ -202,18 +526,23 @@ from mlflow.models.signature import infer_signature
 # The predict method of sklearn's RandomForestClassifier returns a binary classification (0 or 1). 
 # The following code creates a wrapper function, SklearnModelWrapper, that uses 
 # the predict_proba method to return the probability that the observation belongs to each class. 
+# Pass compiled=True to score with a CompiledTreeEnsemble built from the forest instead of calling predict_proba.
 
 class SklearnModelWrapper(mlflow.pyfunc.PythonModel):
-  def __init__(self, model):
+  def __init__(self, model, compiled=False):
     self.model = model
+    self.compiled_model = CompiledTreeEnsemble.from_sklearn(model) if compiled else None
     
   def predict(self, context, model_input):
+    # Wrappers pickled before the compiled mode existed have no compiled_model attribute
+    if getattr(self, 'compiled_model', None) is not None:
+      return self.compiled_model.predict(model_input)
     return self.model.predict_proba(model_input)[:,1]
 
 # mlflow.start_run creates a new MLflow run to track the performance of this model. 
 # Within the context, you call mlflow.log_param to keep track of the parameters used, and
 # mlflow.log_metric to record metrics like accuracy.
-with mlflow.start_run(run_name='untuned_random_forest'):
+with mlflow.start_run(run_name='untuned_random_forest') as rf_run:
   n_estimators = 10
   model = RandomForestClassifier(n_estimators=n_estimators, random_state=np.random.RandomState(123))
   model.fit(X_train, y_train)
@@ -227,11 +556,72 @@ with mlflow.start_run(run_name='untuned_random_forest'):
   wrappedModel = SklearnModelWrapper(model)
   # Log the model with a signature that defines the schema of the model's inputs and outputs. 
   # When the model is deployed, this signature will be used to validate inputs.
-  signature = infer_signature(X_train, wrappedModel.predict(None, X_train))
+  signature = sample_signature(X_train, predict_fn=lambda sample: wrappedModel.predict(None, sample))
   mlflow.pyfunc.log_model("random_forest_model", python_model=wrappedModel, signature=signature)
 
 # COMMAND ----------
 
+# MAGIC %md Check that the compiled inference mode reproduces the scikit-learn predictions.
+
+# COMMAND ----------
+
+compiled_wrapped_model = SklearnModelWrapper(model, compiled=True)
+np.testing.assert_allclose(compiled_wrapped_model.predict(None, X_test), wrappedModel.predict(None, X_test), atol=1e-9)
+
+# COMMAND ----------
+
+# MAGIC %md #### Logging a compact forest
+# MAGIC 
+# MAGIC A pickled `RandomForestClassifier` stores float64 node arrays plus everything scikit-learn needs for training, such as impurities, sample counts and per-class values. Serving needs none of that. `log_compact_forest` logs the forest in a compact format instead, as a `CompiledTreeEnsemble` saved to a `.npz` artifact:
+# MAGIC 
+# MAGIC - Only the split feature, threshold, children, missing-value direction and leaf value of each node are stored, with int16/int32 indices.
+# MAGIC - Thresholds are stored as float32. Features are compared as float32 anyway, so rounding each threshold towards the right side keeps every split decision exactly as before.
+# MAGIC - Leaf values are stored as float32, which is the only source of prediction error.
+# MAGIC - Splits whose subtrees all end in the same leaf value are replaced by that leaf.
+# MAGIC 
+# MAGIC Before logging, the compact model is scored against `predict_proba` on an evaluation set. The largest absolute difference, the change in AUC and the size of both formats are logged as metrics. If the difference exceeds `tolerance`, logging fails.
+
+# COMMAND ----------
+
+import os
+import pickle
+import tempfile
+
+class CompactForestModel(mlflow.pyfunc.PythonModel):
+  def load_context(self, context):
+    self.model = CompiledTreeEnsemble.load(context.artifacts['forest'])
+
+  def predict(self, context, model_input):
+    return self.model.predict(model_input)
+
+def log_compact_forest(forest, artifact_path, X_eval, y_eval, tolerance=1e-6, signature=None):
+  compact = CompiledTreeEnsemble.from_sklearn(forest).compacted()
+  reference_predictions = forest.predict_proba(X_eval)[:, 1]
+  compact_predictions = compact.predict(X_eval)
+  max_abs_diff = float(np.abs(compact_predictions - reference_predictions).max())
+  with tempfile.TemporaryDirectory() as tmp:
+    forest_path = os.path.join(tmp, 'forest.npz')
+    compact.save(forest_path)
+    mlflow.log_metrics({
+      'compact_max_abs_diff': max_abs_diff,
+      'compact_auc_delta': roc_auc_score(y_eval, compact_predictions) - roc_auc_score(y_eval, reference_predictions),
+      'compact_size_bytes': os.path.getsize(forest_path),
+      'pickled_size_bytes': len(pickle.dumps(forest)),
+    })
+    if max_abs_diff > tolerance:
+      raise Exception(f'Compact forest predictions differ by up to {max_abs_diff}, more than the tolerance of {tolerance}')
+    mlflow.pyfunc.log_model(artifact_path, python_model=CompactForestModel(), artifacts={'forest': forest_path},
+                            signature=signature)
+  return compact
+
+# COMMAND ----------
+
+# Log the compact format next to the pickled forest in the baseline run
+with mlflow.start_run(run_id=rf_run.info.run_id):
+  compact_forest = log_compact_forest(model, "compact_random_forest_model", X_test, y_test, signature=signature)
+
+# COMMAND ----------
+
 # MAGIC %md Examine the learned feature importances output by the model as a sanity-check.
 
 # COMMAND ----------
@@ -241,6 +631,63 @@ feature_importances.sort_values('importance', ascending=False)
 
 # COMMAND ----------
 
+# MAGIC %md Impurity-based importances are computed from the training data and favor features with many distinct values. Permutation importance measures instead how much the test AUC drops when one feature's values are shuffled. `permutation_importance` spreads the (feature, repeat) grid over a pool of forked worker processes. Each worker keeps a single copy of the test matrix, shuffles one column of it in place for each task and restores the column afterwards, rather than copying `X_test` for every feature. The results are logged to the model's MLflow run as metrics and as a CSV artifact.
+
+# COMMAND ----------
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Per-process state of the permutation workers, set up once by the pool initializer
+_permutation_state = {}
+
+def _init_permutation_worker(predict_fn, X, y, metric):
+  # Forked workers receive these arguments without pickling; each worker owns its buffer, so it can shuffle it in place
+  _permutation_state.update(predict_fn=predict_fn, X=X.copy(), y=y, metric=metric)
+
+def _permutation_score(feature_index, seed):
+  X = _permutation_state['X']
+  original = X[:, feature_index].copy()
+  X[:, feature_index] = np.random.RandomState(seed).permutation(original)
+  try:
+    return _permutation_state['metric'](_permutation_state['y'], _permutation_state['predict_fn'](X))
+  finally:
+    X[:, feature_index] = original
+
+def permutation_importance(predict_fn, X, y, metric=roc_auc_score, n_repeats=5, max_workers=None, seed=123):
+  feature_names = list(X.columns)
+  X = np.ascontiguousarray(X, dtype=np.float32)
+  y = np.asarray(y)
+  baseline = metric(y, predict_fn(X))
+  seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=(len(feature_names), n_repeats))
+  scores = np.empty(seeds.shape)
+  with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'),
+                           initializer=_init_permutation_worker, initargs=(predict_fn, X, y, metric)) as executor:
+    futures = {executor.submit(_permutation_score, j, int(seeds[j, r])): (j, r)
+               for j in range(len(feature_names)) for r in range(n_repeats)}
+    for future in as_completed(futures):
+      scores[futures[future]] = future.result()
+  importances = baseline - scores
+  return pd.DataFrame({
+    'importance_mean': importances.mean(axis=1),
+    'importance_std': importances.std(axis=1),
+  }, index=feature_names).sort_values('importance_mean', ascending=False)
+
+def log_permutation_importance(run_id, importances):
+  with mlflow.start_run(run_id=run_id):
+    mlflow.log_metrics({f'permutation_importance_{name}': value for name, value in importances.importance_mean.items()})
+    mlflow.log_text(importances.to_csv(), 'permutation_importance.csv')
+
+# COMMAND ----------
+
+# The forest was fit on a DataFrame, so give it one; the wrapper is a zero-copy view of the shuffled buffer
+rf_permutation_importances = permutation_importance(
+  lambda X: model.predict_proba(pd.DataFrame(X, columns=X_test.columns, copy=False))[:, 1], X_test, y_test)
+log_permutation_importance(rf_run.info.run_id, rf_permutation_importances)
+rf_permutation_importances
+
+# COMMAND ----------
+
 # MAGIC %md As illustrated by the boxplots shown previously, both alcohol and density are important in predicting quality.
 
 # COMMAND ----------
@@ -262,7 +709,130 @@ feature_importances.sort_values('importance', ascending=False)
 
 # COMMAND ----------
 
-run_id = mlflow.search_runs(filter_string='tags.mlflow.runName = "untuned_random_forest"').iloc[0].run_id
+# MAGIC %md #### Looking up runs
+# MAGIC 
+# MAGIC `mlflow.search_runs` returns every matching run of the experiment as a DataFrame, even when you only need one row. That gets slow once an experiment holds tens of thousands of runs. `RunIndex` keeps a local SQLite copy of the run metadata, with indexes on run name, parent run and metric value, so the best run or a run with a given name is a single indexed query:
+# MAGIC 
+# MAGIC - `sync` fetches only runs that started since the last sync, plus runs that were still running at that time, since they may have logged more metrics since.
+# MAGIC - `top_k` returns the best runs by a metric, optionally restricted to the children of one parent run.
+# MAGIC - `find` returns the runs with a given name, newest first.
+# MAGIC 
+# MAGIC Both return the same columns as `mlflow.search_runs` (`run_id`, `metrics.<key>`, `params.<key>`, `tags.<key>`), and sync first unless you pass `sync=False`. Runs deleted after they were indexed stay in the index.
+
+# COMMAND ----------
+
+import os
+import sqlite3
+import tempfile
+import threading
+from mlflow.entities import RunStatus
+from mlflow.tracking import MlflowClient
+
+class RunIndex:
+  _schema = """
+    CREATE TABLE IF NOT EXISTS runs (
+      run_id TEXT PRIMARY KEY, experiment_id TEXT, run_name TEXT, parent_run_id TEXT,
+      status TEXT, start_time INTEGER, end_time INTEGER, artifact_uri TEXT);
+    CREATE TABLE IF NOT EXISTS metrics (run_id TEXT, key TEXT, value REAL, PRIMARY KEY (run_id, key));
+    CREATE TABLE IF NOT EXISTS params (run_id TEXT, key TEXT, value TEXT, PRIMARY KEY (run_id, key));
+    CREATE TABLE IF NOT EXISTS tags (run_id TEXT, key TEXT, value TEXT, PRIMARY KEY (run_id, key));
+    CREATE TABLE IF NOT EXISTS sync_state (experiment_id TEXT PRIMARY KEY, watermark INTEGER);
+    CREATE INDEX IF NOT EXISTS runs_by_name ON runs (experiment_id, run_name, start_time);
+    CREATE INDEX IF NOT EXISTS runs_by_parent ON runs (parent_run_id);
+    CREATE INDEX IF NOT EXISTS runs_by_status ON runs (experiment_id, status);
+    CREATE INDEX IF NOT EXISTS metrics_by_value ON metrics (key, value);
+  """
+
+  def __init__(self, experiment_id, client=None, path=None, page_size=1000):
+    self.experiment_id = str(experiment_id)
+    self.client = client or MlflowClient()
+    self.page_size = page_size
+    self.path = path or os.path.join(tempfile.gettempdir(), f'mlflow_run_index_{self.experiment_id}.db')
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(self.path, check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.executescript(self._schema)
+
+  def sync(self):
+    with self._lock:
+      row = self._db.execute('SELECT watermark FROM sync_state WHERE experiment_id = ?', (self.experiment_id,)).fetchone()
+      watermark = row[0] if row else 0
+      running = [run_id for run_id, in self._db.execute(
+        'SELECT run_id FROM runs WHERE experiment_id = ? AND status IN (?, ?)',
+        (self.experiment_id, RunStatus.to_string(RunStatus.RUNNING), RunStatus.to_string(RunStatus.SCHEDULED)))]
+    runs = [self.client.get_run(run_id) for run_id in running]
+    # Runs that start in the same millisecond as the watermark are fetched again; the upsert makes that harmless
+    page_token = None
+    while True:
+      page = self.client.search_runs(
+        [self.experiment_id], filter_string=f'attributes.start_time >= {watermark}',
+        order_by=['attributes.start_time ASC'], max_results=self.page_size, page_token=page_token)
+      runs.extend(page)
+      page_token = page.token
+      if not page_token:
+        break
+    with self._lock, self._db:
+      for run in runs:
+        self._upsert(run)
+      if runs:
+        watermark = max([watermark] + [run.info.start_time for run in runs])
+        self._db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', (self.experiment_id, watermark))
+    return len(runs)
+
+  def top_k(self, metric, k=1, parent_run_id=None, ascending=False, sync=True):
+    if sync:
+      self.sync()
+    query = ('SELECT runs.run_id FROM metrics JOIN runs ON runs.run_id = metrics.run_id '
+             'WHERE metrics.key = ? AND runs.experiment_id = ?')
+    args = [metric, self.experiment_id]
+    if parent_run_id is not None:
+      query += ' AND runs.parent_run_id = ?'
+      args.append(parent_run_id)
+    query += f" ORDER BY metrics.value {'ASC' if ascending else 'DESC'} LIMIT ?"
+    return self._frame(query, args + [k])
+
+  def find(self, run_name, sync=True):
+    if sync:
+      self.sync()
+    return self._frame('SELECT run_id FROM runs WHERE experiment_id = ? AND run_name = ? ORDER BY start_time DESC',
+                       [self.experiment_id, run_name])
+
+  def close(self):
+    self._db.close()
+
+  def _upsert(self, run):
+    info, data = run.info, run.data
+    run_id = info.run_id
+    self._db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+      run_id, info.experiment_id, data.tags.get('mlflow.runName'), data.tags.get('mlflow.parentRunId'),
+      info.status, info.start_time, info.end_time, info.artifact_uri))
+    for table, values in (('metrics', data.metrics), ('params', data.params), ('tags', data.tags)):
+      self._db.execute(f'DELETE FROM {table} WHERE run_id = ?', (run_id,))
+      self._db.executemany(f'INSERT INTO {table} VALUES (?, ?, ?)', [(run_id, key, value) for key, value in values.items()])
+
+  def _frame(self, query, args):
+    # Resolve the matching run ids first, then expand only those runs into search_runs-style columns
+    with self._lock:
+      run_ids = [run_id for run_id, in self._db.execute(query, args)]
+      placeholders = ', '.join('?' * len(run_ids))
+      runs = pd.read_sql_query(
+        f'SELECT run_id, experiment_id, status, artifact_uri, start_time, end_time FROM runs WHERE run_id IN ({placeholders})',
+        self._db, params=run_ids).set_index('run_id')
+      for table in ('metrics', 'params', 'tags'):
+        values = pd.read_sql_query(f'SELECT run_id, key, value FROM {table} WHERE run_id IN ({placeholders})',
+                                   self._db, params=run_ids)
+        runs = runs.join(values.pivot(index='run_id', columns='key', values='value').add_prefix(f'{table}.'))
+    for column in ('start_time', 'end_time'):
+      runs[column] = pd.to_datetime(runs[column], unit='ms', utc=True)
+    # Keep the order of the query that selected the runs
+    return runs.loc[run_ids].reset_index()
+
+# Every run in this notebook is logged to the notebook's experiment
+run_index = RunIndex(rf_run.info.experiment_id)
+
+# COMMAND ----------
+
+run_id = run_index.find("untuned_random_forest").iloc[0].run_id
 
 # COMMAND ----------
 
@@ -300,7 +870,144 @@ client.transition_model_version_stage(
 
 # COMMAND ----------
 
-model = mlflow.pyfunc.load_model(f"models:/{model_name}/production")
+# MAGIC %md #### Caching loaded models
+# MAGIC 
+# MAGIC Every `mlflow.pyfunc.load_model(f"models:/{model_name}/production")` call resolves the stage, downloads the artifacts and unpickles the model again. `ModelCache` keeps loaded models in memory, keyed by model name and resolved version:
+# MAGIC 
+# MAGIC - Loaded models are kept in least-recently-used order and evicted once their combined artifact size exceeds `max_bytes`.
+# MAGIC - Downloaded artifacts are kept under `cache_dir`, so a restarted process can skip the download.
+# MAGIC - A background thread re-resolves each stage every `refresh_interval` seconds. When a new version has been promoted, it loads that version first and then swaps it in atomically, so callers never see a half-loaded model. Call `refresh` to pick up a promotion immediately.
+
+# COMMAND ----------
+
+import os
+import shutil
+import tempfile
+import threading
+import warnings
+from collections import OrderedDict
+import mlflow.artifacts
+
+class ModelCache:
+  def __init__(self, client=None, max_bytes=2 * 1024 ** 3, refresh_interval=60, cache_dir=None):
+    self.client = client or MlflowClient()
+    self.max_bytes = max_bytes
+    self.refresh_interval = refresh_interval
+    self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), 'mlflow_model_cache')
+    # (name, version) -> (model, size in bytes), least recently used first
+    self._models = OrderedDict()
+    # (name, stage) -> version currently served for that stage
+    self._versions = {}
+    self._lock = threading.RLock()
+    self._load_locks = {}
+    self._stop = threading.Event()
+    self._refresher = None
+
+  def get(self, name, stage='Production'):
+    return self.get_with_version(name, stage)[1]
+
+  def get_with_version(self, name, stage='Production'):
+    # Returns the model together with the version it was loaded from, resolved once so the two always agree
+    version = self.version(name, stage)
+    return version, self._load(name, version)
+
+  def version(self, name, stage='Production'):
+    key = (name, stage.capitalize())
+    with self._lock:
+      version = self._versions.get(key)
+    if version is None:
+      version = self._resolve(*key)
+      with self._lock:
+        version = self._versions.setdefault(key, version)
+      self._start_refresher()
+    return version
+
+  def refresh(self, name=None):
+    with self._lock:
+      tracked = [key for key in self._versions if name is None or key[0] == name]
+    for key in tracked:
+      version = self._resolve(*key)
+      if version != self._versions.get(key):
+        # Load the new version before publishing it, so readers switch from one fully loaded model to the next
+        self._load(key[0], version)
+        with self._lock:
+          self._versions[key] = version
+
+  def close(self):
+    self._stop.set()
+
+  def _resolve(self, name, stage):
+    versions = self.client.get_latest_versions(name, stages=[stage])
+    if not versions:
+      raise Exception(f'No version of model {name} is in stage {stage}')
+    return versions[0].version
+
+  def _load(self, name, version):
+    key = (name, version)
+    with self._lock:
+      if key in self._models:
+        self._models.move_to_end(key)
+        return self._models[key][0]
+      load_lock = self._load_locks.setdefault(key, threading.Lock())
+    # Only one thread downloads a given version; the others wait for it and then hit the cache
+    with load_lock:
+      with self._lock:
+        if key in self._models:
+          return self._models[key][0]
+      local_path = self._download(name, version)
+      model = mlflow.pyfunc.load_model(local_path)
+      size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(local_path) for f in files)
+      with self._lock:
+        self._models[key] = (model, size)
+        self._load_locks.pop(key, None)
+        self._evict()
+    return model
+
+  def _download(self, name, version):
+    local_path = os.path.join(self.cache_dir, name, str(version))
+    if os.path.exists(os.path.join(local_path, 'MLmodel')):
+      return local_path
+    # Download next to the final location and rename, so an interrupted download is never mistaken for a complete one
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    staging_path = tempfile.mkdtemp(dir=os.path.dirname(local_path))
+    downloaded_path = mlflow.artifacts.download_artifacts(artifact_uri=f'models:/{name}/{version}', dst_path=staging_path)
+    try:
+      os.rename(downloaded_path, local_path)
+    except OSError:
+      # Another process finished the same download first
+      shutil.rmtree(staging_path, ignore_errors=True)
+    return local_path
+
+  def _evict(self):
+    in_use = set((name, version) for (name, _), version in self._versions.items())
+    total = sum(size for _, size in self._models.values())
+    for key in list(self._models):
+      if total <= self.max_bytes:
+        break
+      # Never drop a model that a stage currently points to
+      if key in in_use:
+        continue
+      total -= self._models.pop(key)[1]
+
+  def _start_refresher(self):
+    with self._lock:
+      if self._refresher is not None or self.refresh_interval is None:
+        return
+      self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+      self._refresher.start()
+
+  def _refresh_loop(self):
+    while not self._stop.wait(self.refresh_interval):
+      try:
+        self.refresh()
+      except Exception as e:
+        warnings.warn(f'Model cache refresh failed: {e}')
+
+model_cache = ModelCache(client)
+
+# COMMAND ----------
+
+model = model_cache.get(model_name, stage="Production")
 
 # Sanity-check: This should match the AUC logged by MLflow
 print(f'AUC: {roc_auc_score(y_test, model.predict(X_test))}')
@@ -316,6 +1023,237 @@ print(f'AUC: {roc_auc_score(y_test, model.predict(X_test))}')
 
 # COMMAND ----------
 
+# MAGIC %md Each trial of the sweep trains on the same data. Rather than converting `X_train` and `X_test` to xgboost matrices in every trial, the raw arrays are broadcast to the workers once, and each worker builds the matrices on first use and reuses them for every later trial it runs. With `tree_method='hist'`, the training matrix is a `QuantileDMatrix`, so its histogram quantile sketch is also computed only once per worker.
+
+# COMMAND ----------
+
+import sys
+import xgboost as xgb
+
+# Python workers are reused across tasks (spark.python.worker.reuse), but the function shipped to them is unpickled
+# again for every task. State that must outlive a task is therefore kept on the worker's own __main__ module.
+def _worker_cache():
+  return sys.modules['__main__'].__dict__.setdefault('_wine_quality_worker_cache', {})
+
+# Only the broadcast handle is pickled into the trial closure, not the data itself
+sweep_data = spark.sparkContext.broadcast({
+  'X_train': X_train.to_numpy(dtype=np.float32),
+  'y_train': y_train.to_numpy(),
+  'X_test': X_test.to_numpy(dtype=np.float32),
+  'y_test': y_test.to_numpy(),
+  'feature_names': X_train.columns.tolist(),
+  # A few rows of the test set are enough to infer the model signature (see sample_signature)
+  'signature_sample': X_test.head(100),
+})
+
+def get_sweep_dmatrices(use_quantile_dmatrix=False, data=sweep_data):
+  cache = _worker_cache()
+  key = ('sweep_dmatrices', data.id, use_quantile_dmatrix)
+  if key not in cache:
+    value = data.value
+    if use_quantile_dmatrix and hasattr(xgb, 'QuantileDMatrix'):
+      train = xgb.QuantileDMatrix(value['X_train'], label=value['y_train'], feature_names=value['feature_names'])
+      # ref=train reuses the training quantile cuts instead of sketching the eval set again
+      test = xgb.QuantileDMatrix(value['X_test'], label=value['y_test'], feature_names=value['feature_names'], ref=train)
+    else:
+      train = xgb.DMatrix(value['X_train'], label=value['y_train'], feature_names=value['feature_names'])
+      test = xgb.DMatrix(value['X_test'], label=value['y_test'], feature_names=value['feature_names'])
+    cache[key] = (train, test)
+  return cache[key]
+
+# COMMAND ----------
+
+# MAGIC %md Logging each trial's parameters, metrics and model synchronously leaves the trial waiting on the tracking server, which is slow under load. `AsyncRunLogger` queues params, metrics, tags and artifacts, and a background thread writes them with batched `log_batch` calls while the trial keeps training. Its `start_run` context manager flushes everything queued before the run is marked finished or failed, so nothing is lost when a trial ends or raises. Every worker process gets its own logger through `get_run_logger`.
+# MAGIC 
+# MAGIC With `LOG_BEST_MODELS_ONLY = True`, a trial only logs its model if it beats the best AUC its worker has seen so far in the same sweep. The best AUC is tracked per parent run, so rerunning the sweep on the same workers starts from scratch. The overall best trial always beats everything its own worker saw, so its model is always logged.
+
+# COMMAND ----------
+
+import atexit
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from mlflow.entities import Metric, Param, RunTag
+from mlflow.models import Model
+from mlflow.tracking import MlflowClient
+
+class AsyncRunLogger:
+  # Per-request limits of the MLflow log_batch API
+  MAX_METRICS_PER_BATCH = 1000
+  MAX_PARAMS_PER_BATCH = 100
+  MAX_TAGS_PER_BATCH = 100
+
+  def __init__(self):
+    self.client = MlflowClient()
+    self._best = {}
+    self._best_lock = threading.Lock()
+    self._pid = None
+    atexit.register(self.flush, raise_errors=False)
+
+  def log_params(self, run_id, params):
+    self._put(('params', run_id, [Param(key, str(value)) for key, value in params.items()]))
+
+  def log_metrics(self, run_id, metrics, step=0):
+    timestamp = int(time.time() * 1000)
+    self._put(('metrics', run_id, [Metric(key, float(value), timestamp, step) for key, value in metrics.items()]))
+
+  def log_metric_history(self, run_id, key, values):
+    timestamp = int(time.time() * 1000)
+    self._put(('metrics', run_id, [Metric(key, float(value), timestamp, step) for step, value in enumerate(values)]))
+
+  def set_tags(self, run_id, tags):
+    self._put(('tags', run_id, [RunTag(key, str(value)) for key, value in tags.items()]))
+
+  def log_model(self, run_id, flavor, model, artifact_path, **kwargs):
+    # Saving to local disk is fast; only the upload happens in the background.
+    # Recording the run and artifact path in the MLmodel file makes the result look like any other logged model.
+    local_dir = tempfile.mkdtemp()
+    flavor.save_model(model, os.path.join(local_dir, artifact_path),
+                      mlflow_model=Model(artifact_path=artifact_path, run_id=run_id), **kwargs)
+    self._put(('artifacts', run_id, local_dir))
+
+  def is_new_best(self, key, value, greater_is_better=True):
+    with self._best_lock:
+      best = self._best.get(key)
+      if best is None or (value > best if greater_is_better else value < best):
+        self._best[key] = value
+        return True
+      return False
+
+  def flush(self, raise_errors=True):
+    if self._pid != os.getpid():
+      return
+    self._queue.join()
+    errors, self._errors = self._errors, []
+    if errors and raise_errors:
+      raise Exception(f'{len(errors)} MLflow logging requests failed, first error: {errors[0]}')
+
+  @contextmanager
+  def start_run(self, **kwargs):
+    with mlflow.start_run(**kwargs) as run:
+      try:
+        yield run
+      except BaseException:
+        self.flush(raise_errors=False)
+        raise
+      self.flush()
+
+  def _put(self, item):
+    # A forked worker inherits this object but not its background thread, so each process starts its own
+    if self._pid != os.getpid():
+      self._queue = queue.Queue()
+      self._errors = []
+      threading.Thread(target=self._write_loop, daemon=True).start()
+      self._pid = os.getpid()
+    self._queue.put(item)
+
+  def _write_loop(self):
+    while True:
+      # Write everything that queued up while the previous batch was being sent
+      items = [self._queue.get()]
+      while True:
+        try:
+          items.append(self._queue.get_nowait())
+        except queue.Empty:
+          break
+      try:
+        self._write(items)
+      except Exception as e:
+        self._errors.append(e)
+      finally:
+        for _ in items:
+          self._queue.task_done()
+
+  def _write(self, items):
+    batches = {}
+    for kind, run_id, payload in items:
+      if kind == 'artifacts':
+        continue
+      batches.setdefault(run_id, {'metrics': [], 'params': [], 'tags': []})[kind].extend(payload)
+    for run_id, batch in batches.items():
+      for kind, size in (('params', self.MAX_PARAMS_PER_BATCH), ('tags', self.MAX_TAGS_PER_BATCH), ('metrics', self.MAX_METRICS_PER_BATCH)):
+        entities = batch[kind]
+        for start in range(0, len(entities), size):
+          self.client.log_batch(run_id, **{kind: entities[start:start + size]})
+    for kind, run_id, local_dir in items:
+      if kind == 'artifacts':
+        try:
+          self.client.log_artifacts(run_id, local_dir)
+        finally:
+          shutil.rmtree(local_dir, ignore_errors=True)
+
+def get_run_logger():
+  cache = _worker_cache()
+  if 'run_logger' not in cache:
+    cache['run_logger'] = AsyncRunLogger()
+  return cache['run_logger']
+
+LOG_BEST_MODELS_ONLY = True
+
+# COMMAND ----------
+
+# MAGIC %md #### Warm-starting the sweep
+# MAGIC 
+# MAGIC Earlier sweeps have already logged the same hyperparameters and AUC to MLflow. `load_prior_trials` finds their finished child runs with `mlflow.search_runs` and inserts their (params, loss) pairs into the `Trials` object as completed trials, so TPE starts from an informed posterior instead of from scratch.
+# MAGIC 
+# MAGIC Each trial run is tagged with a hash of the training and test data and a hash of the search space. Only runs whose tags match the current data and `search_space` are loaded; `max_age_days` can drop older runs as well. Because `fmin` counts the loaded trials toward `max_evals`, pass the number of prior trials plus the number of new evaluations.
+
+# COMMAND ----------
+
+import hashlib
+import time
+from hyperopt import STATUS_OK, pyll
+from hyperopt.base import JOB_STATE_DONE, Domain
+
+def dataset_hash(*frames):
+  digest = hashlib.sha256()
+  for frame in frames:
+    digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+  return digest.hexdigest()[:16]
+
+def search_space_hash(space):
+  # The printed pyll graph includes every label, distribution and bound, but no object ids
+  return hashlib.sha256(str(pyll.as_apply(space)).encode()).hexdigest()[:16]
+
+def load_prior_trials(trials, fn, space, tags, metric='auc', max_results=1000, max_age_days=None):
+  filters = [f"tags.{key} = '{value}'" for key, value in tags.items()] + ["attributes.status = 'FINISHED'"]
+  if max_age_days is not None:
+    filters.append(f"attributes.start_time > {int((time.time() - max_age_days * 86400) * 1000)}")
+  runs = mlflow.search_runs(filter_string=' and '.join(filters), order_by=[f'metrics.{metric} DESC'], max_results=max_results)
+  domain = Domain(fn, space)
+  labels = list(domain.params)
+  columns = [f'params.{label}' for label in labels] + [f'metrics.{metric}']
+  if runs.empty or not set(columns).issubset(runs.columns):
+    return 0
+  runs = runs.dropna(subset=columns)
+
+  tids = trials.new_trial_ids(len(runs))
+  docs = []
+  for tid, (_, run) in zip(tids, runs.iterrows()):
+    # Every hyperparameter in the search space is numeric, so the logged value is also hyperopt's internal value
+    misc = {
+      'tid': tid,
+      'cmd': domain.cmd,
+      'workdir': domain.workdir,
+      'idxs': {label: [tid] for label in labels},
+      'vals': {label: [float(run[f'params.{label}'])] for label in labels},
+    }
+    result = {'status': STATUS_OK, 'loss': -float(run[f'metrics.{metric}'])}
+    docs.extend(trials.new_trial_docs([tid], [None], [result], [misc]))
+  for doc in docs:
+    doc['state'] = JOB_STATE_DONE
+  trials.insert_trial_docs(docs)
+  trials.refresh()
+  return len(docs)
+
+WARM_START = True
+
+# COMMAND ----------
+
 from hyperopt import fmin, tpe, hp, SparkTrials, Trials, STATUS_OK
 from hyperopt.pyll import scope
 from math import exp
@@ -330,25 +1268,40 @@ search_space = {
   'reg_lambda': hp.loguniform('reg_lambda', -6, -1),
   'min_child_weight': hp.loguniform('min_child_weight', -1, 3),
   'objective': 'binary:logistic',
+  'tree_method': 'hist',
   'seed': 123, # Set a seed for deterministic training
 }
 
+# Tag every trial with the data and search space it was trained on, so later sweeps can warm-start from it
+sweep_tags = {'dataset_hash': dataset_hash(train, test), 'search_space_hash': search_space_hash(search_space)}
+
 def train_model(params):
-  # With MLflow autologging, hyperparameters and the trained model are automatically logged to MLflow.
-  mlflow.xgboost.autolog()
-  with mlflow.start_run(nested=True):
-    train = xgb.DMatrix(data=X_train, label=y_train)
-    test = xgb.DMatrix(data=X_test, label=y_test)
+  # Params, metrics and the model are queued on the worker's AsyncRunLogger and written in the background.
+  run_logger = get_run_logger()
+  with run_logger.start_run(nested=True) as run:
+    run_id = run.info.run_id
+    run_logger.log_params(run_id, params)
+    run_logger.set_tags(run_id, sweep_tags)
+    # Reuse the matrices (and, with hist, the quantile sketch) already built on this worker
+    train, test = get_sweep_dmatrices(use_quantile_dmatrix=params.get('tree_method') == 'hist')
     # Pass in the test set so xgb can track an evaluation metric. XGBoost terminates training when the evaluation metric
     # is no longer improving.
+    evals_result = {}
     booster = xgb.train(params=params, dtrain=train, num_boost_round=1000,\
-                        evals=[(test, "test")], early_stopping_rounds=50)
+                        evals=[(test, "test")], early_stopping_rounds=50, evals_result=evals_result, verbose_eval=False)
+    for metric_name, values in evals_result['test'].items():
+      run_logger.log_metric_history(run_id, f'test-{metric_name}', values)
     predictions_test = booster.predict(test)
-    auc_score = roc_auc_score(y_test, predictions_test)
-    mlflow.log_metric('auc', auc_score)
-
-    signature = infer_signature(X_train, booster.predict(train))
-    mlflow.xgboost.log_model(booster, "model", signature=signature)
+    # Read the labels from the broadcast; referencing the driver's y_test would pickle it into every trial
+    auc_score = roc_auc_score(sweep_data.value['y_test'], predictions_test)
+    run_logger.log_metrics(run_id, {'auc': auc_score, 'best_iteration': booster.best_iteration})
+
+    # Track the best AUC per sweep; the logger outlives the sweep on reused Python workers
+    sweep_run_id = run.data.tags.get('mlflow.parentRunId')
+    if not LOG_BEST_MODELS_ONLY or run_logger.is_new_best(('auc', sweep_run_id), auc_score):
+      # The test predictions are already computed, so the signature costs no extra inference
+      signature = sample_signature(sweep_data.value['signature_sample'], model_output=predictions_test)
+      run_logger.log_model(run_id, mlflow.xgboost, booster, "model", signature=signature)
     
     # Set the loss to -1*auc_score so fmin maximizes the auc_score
     return {'status': STATUS_OK, 'loss': -1*auc_score, 'booster': booster.attributes()}
@@ -357,6 +1310,9 @@ def train_model(params):
 # A reasonable value for parallelism is the square root of max_evals.
 spark_trials = SparkTrials(parallelism=10)
 
+# Seed the sweep with matching trials from earlier sweeps. fmin counts them toward max_evals.
+num_prior_trials = load_prior_trials(spark_trials, train_model, search_space, sweep_tags) if WARM_START else 0
+
 # Run fmin within an MLflow run context so that each hyperparameter configuration is logged as a child run of a parent
 # run called "xgboost_models" .
 with mlflow.start_run(run_name='xgboost_models'):
@@ -364,13 +1320,285 @@ with mlflow.start_run(run_name='xgboost_models'):
     fn=train_model, 
     space=search_space, 
     algo=tpe.suggest, 
-    max_evals=96,
+    max_evals=num_prior_trials + 96,
     trials=spark_trials, 
     rstate=np.random.RandomState(123)
   )
 
 # COMMAND ----------
 
+# MAGIC %md #### Running the sweep on a single node
+# MAGIC 
+# MAGIC `SparkTrials` needs a Spark cluster, and the serial `Trials` backend leaves most cores idle. `LocalProcessTrials` is a drop-in `Trials` backend that evaluates `train_model` on a pool of `parallelism` local worker processes:
+# MAGIC 
+# MAGIC - Each trial receives `nthread=threads_per_trial` in its params (by default, the cores divided evenly among the workers), so that concurrent xgboost trials don't oversubscribe the machine. If `threadpoolctl` is installed, BLAS thread pools are limited as well.
+# MAGIC - A trial that runs longer than `trial_timeout` seconds is killed and recorded as failed, and its worker is replaced. `cancel()` stops the whole sweep.
+# MAGIC - Workers are long-lived, so caches such as the sweep matrices built by `get_sweep_dmatrices` are reused across trials. Child runs are still nested under the active parent run.
+# MAGIC 
+# MAGIC Workers are forked from the driver process, so start the sweep before running multi-threaded xgboost code on the driver. GNU OpenMP is not safe to use in a child forked after its thread pool has started. This is why this section comes before successive halving, which trains xgboost models on the driver.
+# MAGIC 
+# MAGIC Uncomment the last cell below to run the sweep with this backend.
+
+# COMMAND ----------
+
+import multiprocessing
+import os
+import threading
+import time
+from hyperopt import STATUS_FAIL, space_eval
+from hyperopt.base import JOB_STATE_CANCEL, JOB_STATE_DONE, JOB_STATE_ERROR, JOB_STATE_NEW, JOB_STATE_RUNNING, spec_from_misc
+from hyperopt.utils import coarse_utcnow
+
+def _local_trial_worker(conn, fn, threads_per_trial, parent_run_id):
+  # The OpenMP runtime may already be initialized in the forked worker, so OMP_NUM_THREADS would have no effect here.
+  # xgboost gets its thread count through nthread below; threadpoolctl, when installed, also limits BLAS.
+  try:
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(threads_per_trial)
+  except ImportError:
+    pass
+  # Resume the parent run in the worker so mlflow.start_run(nested=True) in the trial creates a child of it
+  if parent_run_id is not None and mlflow.active_run() is None:
+    mlflow.start_run(run_id=parent_run_id)
+  while True:
+    try:
+      params = conn.recv()
+    except EOFError:
+      return
+    if isinstance(params, dict):
+      params = {**params, 'nthread': threads_per_trial}
+    try:
+      conn.send(('ok', fn(params)))
+    except Exception as e:
+      conn.send(('error', (type(e).__name__, str(e))))
+
+class LocalProcessTrials(Trials):
+  asynchronous = True
+  # fmin pickles the search domain into trials.attachments for remote workers unless the trials object has a _spark
+  # attribute, as SparkTrials does. The objective here reaches the workers through fork and may reference Spark
+  # broadcasts, which cannot be pickled outside a Spark job.
+  _spark = None
+
+  def __init__(self, parallelism=None, threads_per_trial=None, trial_timeout=None, poll_interval=0.1, exp_key=None, refresh=True):
+    super().__init__(exp_key=exp_key, refresh=refresh)
+    self.parallelism = parallelism or os.cpu_count()
+    self.threads_per_trial = threads_per_trial or max(1, os.cpu_count() // self.parallelism)
+    self.trial_timeout = trial_timeout
+    self.poll_interval = poll_interval
+    self._fmin_cancelled = False
+
+  def fmin(self, fn, space, **kwargs):
+    self._fn = fn
+    self._space = space
+    self._fmin_cancelled = False
+    active_run = mlflow.active_run()
+    self._parent_run_id = active_run.info.run_id if active_run is not None else None
+    self._context = multiprocessing.get_context('fork')
+    self._workers = [self._start_worker() for _ in range(self.parallelism)]
+    self._stop = threading.Event()
+    monitor = threading.Thread(target=self._monitor, daemon=True)
+    monitor.start()
+    # Keep one queued trial per worker so every worker always has work
+    kwargs['max_queue_len'] = self.parallelism
+    try:
+      return super().fmin(fn, space, **kwargs)
+    finally:
+      self._stop.set()
+      monitor.join()
+      self._shutdown()
+
+  def cancel(self):
+    self._fmin_cancelled = True
+
+  def _start_worker(self):
+    conn, child_conn = self._context.Pipe()
+    process = self._context.Process(target=_local_trial_worker, daemon=True,
+                                    args=(child_conn, self._fn, self.threads_per_trial, self._parent_run_id))
+    process.start()
+    child_conn.close()
+    return {'process': process, 'conn': conn, 'doc': None, 'started': None}
+
+  def _monitor(self):
+    while not self._stop.is_set():
+      if self._fmin_cancelled:
+        self._cancel_all()
+      else:
+        self._poll_workers()
+        self._dispatch()
+      self._stop.wait(self.poll_interval)
+
+  def _poll_workers(self):
+    for i, worker in enumerate(self._workers):
+      doc = worker['doc']
+      if doc is None:
+        continue
+      if worker['conn'].poll():
+        status, payload = worker['conn'].recv()
+        if status == 'ok':
+          self._finish(doc, JOB_STATE_DONE, payload if isinstance(payload, dict) else {'loss': payload, 'status': STATUS_OK})
+        else:
+          self._finish(doc, JOB_STATE_ERROR, {'status': STATUS_FAIL}, error=payload)
+        worker['doc'] = None
+      elif not worker['process'].is_alive():
+        self._finish(doc, JOB_STATE_ERROR, {'status': STATUS_FAIL},
+                     error=('WorkerDied', f'worker exited with code {worker["process"].exitcode}'))
+        self._workers[i] = self._start_worker()
+      elif self.trial_timeout is not None and time.monotonic() - worker['started'] > self.trial_timeout:
+        self._stop_worker(worker)
+        self._finish(doc, JOB_STATE_ERROR, {'status': STATUS_FAIL},
+                     error=('TimeoutError', f'trial exceeded {self.trial_timeout} seconds'))
+        self._workers[i] = self._start_worker()
+
+  def _dispatch(self):
+    pending = [doc for doc in self._dynamic_trials if doc['state'] == JOB_STATE_NEW]
+    for worker in self._workers:
+      if not pending:
+        return
+      if worker['doc'] is not None:
+        continue
+      doc = pending.pop(0)
+      # Convert the hyperopt assignment back into the parameter dictionary train_model expects
+      params = space_eval(self._space, spec_from_misc(doc['misc']))
+      doc['state'] = JOB_STATE_RUNNING
+      doc['book_time'] = coarse_utcnow()
+      worker['conn'].send(params)
+      worker['doc'], worker['started'] = doc, time.monotonic()
+
+  def _finish(self, doc, state, result, error=None):
+    doc['result'] = result
+    if error is not None:
+      doc['misc']['error'] = error
+    doc['refresh_time'] = coarse_utcnow()
+    doc['state'] = state
+
+  def _cancel_all(self):
+    for worker in self._workers:
+      if worker['doc'] is not None:
+        self._stop_worker(worker)
+        self._finish(worker['doc'], JOB_STATE_CANCEL, {'status': STATUS_FAIL})
+        worker['doc'] = None
+    for doc in self._dynamic_trials:
+      if doc['state'] == JOB_STATE_NEW:
+        self._finish(doc, JOB_STATE_CANCEL, {'status': STATUS_FAIL})
+
+  def _stop_worker(self, worker):
+    worker['process'].terminate()
+    worker['process'].join()
+
+  def _shutdown(self):
+    # fmin can return early (timeout, loss_threshold, cancel); anything still queued or running is cancelled
+    self._cancel_all()
+    for worker in self._workers:
+      # Closing the pipe ends the worker loop
+      worker['conn'].close()
+      worker['process'].join(timeout=5)
+      if worker['process'].is_alive():
+        worker['process'].terminate()
+
+# COMMAND ----------
+
+# # Single-node alternative to the SparkTrials sweep above
+# local_trials = LocalProcessTrials(parallelism=4, trial_timeout=600)
+
+# with mlflow.start_run(run_name='xgboost_models'):
+#   best_params = fmin(
+#     fn=train_model,
+#     space=search_space,
+#     algo=tpe.suggest,
+#     max_evals=96,
+#     trials=local_trials,
+#     rstate=np.random.RandomState(123)
+#   )
+
+# COMMAND ----------
+
+# MAGIC %md #### Stopping bad configurations early with successive halving
+# MAGIC 
+# MAGIC The sweep above trains every configuration for up to 1000 boosting rounds, even though most configurations are clearly worse than the best ones after a few dozen rounds. `successive_halving` trains configurations in rungs of increasing round budgets instead:
+# MAGIC 
+# MAGIC 1. Sample `num_trials` configurations from `search_space` and train each for `min_rounds` rounds.
+# MAGIC 1. Keep the top `1 / reduction_factor` of the trials by test AUC and continue boosting them (with `xgb_model`) up to `reduction_factor` times the previous budget. Stop the rest.
+# MAGIC 1. Repeat until the remaining trials reach `max_rounds`.
+# MAGIC 
+# MAGIC Every trial is logged as a child run. Its AUC at each rung is logged as `rung_auc` and its outcome as the `successive_halving_status` tag. Only trials that reach the final rung log an `auc` metric and a model, so the best-run search below only sees fully trained models.
+
+# COMMAND ----------
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hyperopt.pyll import stochastic
+from mlflow.entities import Metric, Param, RunTag
+
+def successive_halving(space, num_trials=81, min_rounds=10, max_rounds=1000, reduction_factor=3, early_stopping_rounds=50,
+                       max_workers=4, rstate=None):
+  # Must be called inside the parent run, like fmin above
+  parent_run = mlflow.active_run()
+  rstate = rstate or np.random.RandomState(123)
+  train, test = get_sweep_dmatrices(use_quantile_dmatrix=space.get('tree_method') == 'hist')
+  y_true = sweep_data.value['y_test']
+
+  trials = []
+  for i in range(num_trials):
+    params = stochastic.sample(space, rng=rstate)
+    # The tracking client is thread-safe, unlike the fluent mlflow.start_run API, so trials can run on a thread pool
+    run = client.create_run(parent_run.info.experiment_id, tags={
+      'mlflow.parentRunId': parent_run.info.run_id,
+      'mlflow.runName': f'successive_halving_trial_{i}',
+    })
+    client.log_batch(run.info.run_id, params=[Param(key, str(value)) for key, value in params.items()])
+    trials.append({'params': params, 'run_id': run.info.run_id, 'booster': None, 'auc': None, 'converged': False})
+
+  def train_to_budget(trial, budget):
+    rounds_done = trial['booster'].num_boosted_rounds() if trial['booster'] is not None else 0
+    if trial['converged'] or rounds_done >= budget:
+      return
+    # xgboost releases the GIL while boosting, so trials on the thread pool train in parallel
+    booster = xgb.train(params=trial['params'], dtrain=train, num_boost_round=budget - rounds_done, evals=[(test, "test")],
+                        early_stopping_rounds=early_stopping_rounds, xgb_model=trial['booster'], verbose_eval=False)
+    # Early stopping ended training before the budget was used, so more rounds would not help this trial
+    trial['converged'] = booster.num_boosted_rounds() < budget
+    trial['booster'] = booster
+    trial['auc'] = roc_auc_score(y_true, booster.predict(test))
+    client.log_batch(trial['run_id'], metrics=[
+      Metric('rung_auc', trial['auc'], int(time.time() * 1000), booster.num_boosted_rounds()),
+    ])
+
+  survivors, budget = trials, min_rounds
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    while True:
+      list(executor.map(lambda trial: train_to_budget(trial, budget), survivors))
+      survivors = sorted(survivors, key=lambda trial: trial['auc'], reverse=True)
+      if budget >= max_rounds:
+        break
+      keep = max(1, len(survivors) // reduction_factor)
+      for trial in survivors[keep:]:
+        client.log_batch(trial['run_id'], tags=[RunTag('successive_halving_status', 'stopped')])
+        client.set_terminated(trial['run_id'])
+        # Free the booster; the stopped trial's results are already in MLflow
+        trial['booster'] = None
+      survivors = survivors[:keep]
+      # Once a single trial is left there is nothing to compare it against, so train it to the full budget
+      budget = max_rounds if keep == 1 else min(budget * reduction_factor, max_rounds)
+
+  # Log the final models from the driver thread, where the fluent API can resume each run
+  for trial in survivors:
+    with mlflow.start_run(run_id=trial['run_id'], nested=True):
+      mlflow.set_tag('successive_halving_status', 'completed')
+      mlflow.log_metric('auc', trial['auc'])
+      signature = sample_signature(X_train, predict_fn=lambda sample: trial['booster'].predict(xgb.DMatrix(sample)))
+      mlflow.xgboost.log_model(trial['booster'], "model", signature=signature)
+
+  best_trial = survivors[0]
+  return best_trial['params'], best_trial['auc']
+
+# COMMAND ----------
+
+with mlflow.start_run(run_name='xgboost_successive_halving'):
+  sh_best_params, sh_best_auc = successive_halving(search_space, num_trials=81, min_rounds=10, max_rounds=1000, reduction_factor=3)
+print(f'AUC of best successive halving trial: {sh_best_auc}')
+
+# COMMAND ----------
+
 # MAGIC %md  #### Use MLflow to view the results
 # MAGIC Open up the Experiment Runs sidebar to see the MLflow runs. Click on Date next to the down arrow to display a menu, and select 'auc' to display the runs sorted by the auc metric. The highest auc value is 0.91. You beat the baseline!
 # MAGIC 
@@ -395,11 +1623,31 @@ with mlflow.start_run(run_name='xgboost_models'):
 
 # COMMAND ----------
 
-best_run = mlflow.search_runs(order_by=['metrics.auc DESC']).iloc[0]
+best_run = run_index.top_k('auc').iloc[0]
 print(f'AUC of Best Run: {best_run["metrics.auc"]}')
 
 # COMMAND ----------
 
+# MAGIC %md The compiled inference engine also accepts the xgboost booster. Its predictions should match `booster.predict`.
+
+# COMMAND ----------
+
+best_booster = mlflow.xgboost.load_model(f"runs:/{best_run.run_id}/model")
+compiled_booster = CompiledTreeEnsemble.from_xgboost(best_booster)
+np.testing.assert_allclose(compiled_booster.predict(X_test), best_booster.predict(xgb.DMatrix(X_test)), atol=1e-5)
+
+# COMMAND ----------
+
+# MAGIC %md Compute permutation importances for the best xgboost model as well. The workers are forked after the driver has already run xgboost, and GNU OpenMP is not safe to use in such a child. The workers therefore score with the compiled engine, which is pure NumPy and matches `booster.predict` as checked above.
+
+# COMMAND ----------
+
+xgb_permutation_importances = permutation_importance(compiled_booster.predict, X_test, y_test)
+log_permutation_importance(best_run.run_id, xgb_permutation_importances)
+xgb_permutation_importances
+
+# COMMAND ----------
+
 # MAGIC %md #### Updating the production wine_quality model in the MLflow Model Registry
 # MAGIC 
 # MAGIC Earlier, you saved the baseline model to the Model Registry under "wine_quality". Now that you have a created a more accurate model, update wine_quality.
@@ -437,7 +1685,9 @@ client.transition_model_version_stage(
 # COMMAND ----------
 
 # This code is the same as the last block of "Building a Baseline Model". No change is required for clients to get the new model!
-model = mlflow.pyfunc.load_model(f"models:/{model_name}/production")
+# The model cache picks up the promotion on its next background refresh; refresh() switches it over immediately.
+model_cache.refresh(model_name)
+model = model_cache.get(model_name, stage="Production")
 print(f'AUC: {roc_auc_score(y_test, model.predict(X_test))}')
 
 # COMMAND ----------
@@ -498,6 +1748,183 @@ display(new_data)
 
 # COMMAND ----------
 
+# MAGIC %md #### Scoring with mapInPandas
+# MAGIC 
+# MAGIC `spark_udf` packs the feature columns into a struct and scores each Arrow batch separately. On large tables, deserializing the model and packing the struct take up a large share of executor time. `predict_with_map_in_pandas` instead hands whole partitions to `mapInPandas`. It loads the model once per Python worker, reuses it for every Arrow batch, and reads the feature columns directly.
+# MAGIC 
+# MAGIC - The model artifacts are downloaded once on the driver, like `spark_udf` does, so the executors load them from a shared path instead of each calling the tracking server. On Databricks the path is under `/dbfs`.
+# MAGIC - `probability_col`, when set, adds an `array<double>` column with the `[P(low quality), P(high quality)]` pair.
+# MAGIC - `arrow_records_per_batch` sets `spark.sql.execution.arrow.maxRecordsPerBatch`, the number of rows per pandas batch, and restores the previous value on exit. `mapInPandas` is lazy, so run the action (`display`, `write`, ...) inside the `with` block.
+# MAGIC 
+# MAGIC This also works on a local-mode Spark session.
+
+# COMMAND ----------
+
+import os
+import tempfile
+from contextlib import contextmanager
+from pyspark.sql.types import ArrayType, DoubleType, StructField, StructType
+
+ARROW_BATCH_CONF = 'spark.sql.execution.arrow.maxRecordsPerBatch'
+
+@contextmanager
+def arrow_records_per_batch(spark_session, n_rows):
+  previous = spark_session.conf.get(ARROW_BATCH_CONF, None)
+  spark_session.conf.set(ARROW_BATCH_CONF, str(n_rows))
+  try:
+    yield
+  finally:
+    if previous is None:
+      spark_session.conf.unset(ARROW_BATCH_CONF)
+    else:
+      spark_session.conf.set(ARROW_BATCH_CONF, previous)
+
+def _download_model_for_executors(model_uri):
+  # Executors can read /dbfs on Databricks; in local mode they share the driver's file system
+  root = '/dbfs/tmp/map_in_pandas_models' if os.path.isdir('/dbfs') else tempfile.gettempdir()
+  os.makedirs(root, exist_ok=True)
+  return mlflow.artifacts.download_artifacts(artifact_uri=model_uri, dst_path=tempfile.mkdtemp(dir=root))
+
+# _worker_cache, defined before the hyperparameter sweep, keeps the model on the Python worker across tasks
+def _load_model_once(model_path):
+  cache = _worker_cache()
+  if ('model', model_path) not in cache:
+    cache[('model', model_path)] = mlflow.pyfunc.load_model(model_path)
+  return cache[('model', model_path)]
+
+def predict_with_map_in_pandas(df, model_uri, feature_columns, prediction_col='prediction', probability_col=None):
+  model_path = _download_model_for_executors(model_uri)
+  fields = df.schema.fields + [StructField(prediction_col, DoubleType())]
+  if probability_col is not None:
+    fields.append(StructField(probability_col, ArrayType(DoubleType())))
+  feature_columns = list(feature_columns)
+
+  def predict_batches(batches):
+    model = _load_model_once(model_path)
+    for batch in batches:
+      predictions = np.asarray(model.predict(batch[feature_columns]), dtype=np.float64)
+      batch[prediction_col] = predictions
+      if probability_col is not None:
+        batch[probability_col] = list(np.column_stack([1 - predictions, predictions]))
+      yield batch
+
+  return df.mapInPandas(predict_batches, schema=StructType(fields))
+
+# COMMAND ----------
+
+new_data = predict_with_map_in_pandas(
+  spark.read.format("delta").load(table_path),
+  # Pin the resolved version so every worker loads the same model even if a promotion happens mid-job
+  f"models:/{model_name}/{model_cache.version(model_name)}",
+  X_train.columns,
+  probability_col="probability",
+)
+with arrow_records_per_batch(spark, 10000):
+  display(new_data)
+
+# COMMAND ----------
+
+# MAGIC %md #### Incremental retraining
+# MAGIC 
+# MAGIC Retraining from the full `data` DataFrame gets slower as labeled data accumulates. If the labeled data is kept in an append-only Delta table instead, each registered model version can record the table version it was trained on in a `delta_version` tag. `retrain_incrementally` then reads only the rows appended since that version. It uses the Delta change data feed when the table has it enabled, and otherwise falls back to diffing the two table versions. It updates the current model with those rows:
+# MAGIC 
+# MAGIC - An xgboost model keeps boosting from the current booster (`xgb_model`), adding `num_boost_round` trees fit to the new rows with the hyperparameters of the run that produced it.
+# MAGIC - A random forest grows `n_new_trees` more trees on the new rows (`warm_start`) and keeps its existing trees.
+# MAGIC 
+# MAGIC The result is logged to a new run with its AUC on the test set and registered as a new version of the model, tagged with the table version it has now seen. Promote it as before once you have checked the AUC.
+
+# COMMAND ----------
+
+from delta.tables import DeltaTable
+from pyspark.sql.utils import AnalysisException
+
+# Replace <username> with your username before running this cell.
+training_table_path = "/user/<username>/delta/wine_training_data"
+
+# Keep the labeled training data in an append-only Delta table that records its change feed
+dbutils.fs.rm(training_table_path, True)
+spark.createDataFrame(train).write.format("delta").option("delta.enableChangeDataFeed", "true").save(training_table_path)
+
+# The production model was trained on exactly the rows in version 0 of the table
+client.set_model_version_tag(model_name, model_cache.version(model_name), "delta_version", "0")
+
+# COMMAND ----------
+
+def latest_delta_version(path):
+  return DeltaTable.forPath(spark, path).history(1).first().version
+
+def read_appended_rows(path, since_version, until_version):
+  try:
+    changes = (spark.read.format("delta")
+               .option("readChangeFeed", "true")
+               .option("startingVersion", since_version + 1)
+               .option("endingVersion", until_version)
+               .load(path))
+    # The table is append-only, so inserts are the only changes that matter
+    return changes.where("_change_type = 'insert'").drop("_change_type", "_commit_version", "_commit_timestamp").toPandas()
+  except AnalysisException:
+    # The change feed was not recorded for some of these versions; compare the two snapshots instead
+    after = spark.read.format("delta").option("versionAsOf", until_version).load(path)
+    before = spark.read.format("delta").option("versionAsOf", since_version).load(path)
+    return after.exceptAll(before).toPandas()
+
+def retrain_incrementally(model_name, table_path, stage="Production", num_boost_round=50, n_new_trees=25):
+  current = client.get_latest_versions(model_name, stages=[stage])[0]
+  if "delta_version" not in current.tags:
+    raise Exception(f'Version {current.version} of model {model_name} has no delta_version tag')
+  since_version = int(current.tags["delta_version"])
+  until_version = latest_delta_version(table_path)
+  if until_version == since_version:
+    print(f'No data has been appended to {table_path} since version {since_version}')
+    return None
+
+  new_rows = read_appended_rows(table_path, since_version, until_version)
+  X_new = new_rows[X_train.columns].astype(X_train.dtypes.to_dict())
+  y_new = new_rows.quality
+  model_uri = f"models:/{model_name}/{current.version}"
+  model_info = mlflow.models.get_model_info(model_uri)
+  # The hyperparameters live on the run that first trained the model; retrain runs point back to it with a tag
+  origin_run_id = client.get_run(current.run_id).data.tags.get('origin_run_id', current.run_id)
+
+  with mlflow.start_run(run_name='incremental_retrain', tags={'origin_run_id': origin_run_id}) as run:
+    mlflow.log_params({'base_model_version': current.version, 'since_delta_version': since_version,
+                       'until_delta_version': until_version, 'new_rows': len(new_rows)})
+    # Log under the same fixed paths as the sweep and the baseline, since model_info.artifact_path is not always set
+    artifact_path = 'model' if 'xgboost' in model_info.flavors else 'random_forest_model'
+    if 'xgboost' in model_info.flavors:
+      booster = mlflow.xgboost.load_model(model_uri)
+      # Drop the trees that early stopping added after the best iteration before boosting further
+      if booster.attr('best_iteration') is not None:
+        booster = booster[:int(booster.attr('best_iteration')) + 1]
+      params = client.get_run(origin_run_id).data.params
+      booster = xgb.train(params=params, dtrain=xgb.DMatrix(X_new, label=y_new), num_boost_round=num_boost_round, xgb_model=booster)
+      predictions_test = booster.predict(xgb.DMatrix(X_test))
+      signature = sample_signature(X_test, model_output=predictions_test)
+      mlflow.xgboost.log_model(booster, artifact_path, signature=signature)
+    else:
+      forest = mlflow.pyfunc.load_model(model_uri).unwrap_python_model().model
+      forest.set_params(warm_start=True, n_estimators=forest.n_estimators + n_new_trees)
+      forest.fit(X_new, y_new)
+      wrapped_forest = SklearnModelWrapper(forest)
+      predictions_test = wrapped_forest.predict(None, X_test)
+      signature = sample_signature(X_test, model_output=predictions_test)
+      mlflow.pyfunc.log_model(artifact_path, python_model=wrapped_forest, signature=signature)
+    mlflow.log_metric('auc', roc_auc_score(y_test, predictions_test))
+
+  retrained_version = mlflow.register_model(f"runs:/{run.info.run_id}/{artifact_path}", model_name)
+  client.set_model_version_tag(model_name, retrained_version.version, "delta_version", str(until_version))
+  return retrained_version
+
+# COMMAND ----------
+
+# To simulate a new day of labeled data, append a sample of the training data to the table.
+# In the real world, these would be newly labeled rows.
+spark.createDataFrame(train.sample(frac=0.2, random_state=123)).write.format("delta").mode("append").save(training_table_path)
+
+retrained_model_version = retrain_incrementally(model_name, training_table_path)
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Model serving
 # MAGIC 
@@ -557,3 +1984,655 @@ pd.DataFrame({
   "Model Prediction": model_evaluations,
   "Served Model Prediction": served_predictions,
 })
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Request payload formats
+# MAGIC 
+# MAGIC `score_model` sends the DataFrame as split-oriented JSON. For a table of floats, JSON inflates the payload and encoding and decoding it costs more CPU than scoring the model. The local server and `ScoringClient` below also understand the [Arrow IPC streaming format](https://arrow.apache.org/docs/format/Columnar.html#ipc-streaming-format), selected with the `Content-Type` and `Accept` headers. JSON remains the default and the fallback.
+
+# COMMAND ----------
+
+import json
+import pyarrow as pa
+
+JSON_CONTENT_TYPE = 'application/json'
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+SUPPORTED_CONTENT_TYPES = (JSON_CONTENT_TYPE, ARROW_CONTENT_TYPE)
+
+def _write_arrow_stream(table):
+  sink = pa.BufferOutputStream()
+  with pa.ipc.new_stream(sink, table.schema) as writer:
+    writer.write_table(table)
+  return sink.getvalue().to_pybytes()
+
+def _read_arrow_stream(body):
+  # pa.py_buffer wraps the bytes without copying them
+  return pa.ipc.open_stream(pa.py_buffer(body)).read_all()
+
+def encode_frame(dataset: pd.DataFrame, content_type=JSON_CONTENT_TYPE) -> bytes:
+  if content_type == ARROW_CONTENT_TYPE:
+    return _write_arrow_stream(pa.Table.from_pandas(dataset, preserve_index=False))
+  return json.dumps(dataset.to_dict(orient='split')).encode()
+
+def decode_frame(body: bytes, content_type=JSON_CONTENT_TYPE) -> pd.DataFrame:
+  if content_type == ARROW_CONTENT_TYPE:
+    # split_blocks gives every column its own block, so null-free numeric columns become NumPy views
+    # of the Arrow buffers instead of being copied into one consolidated 2D block
+    return _read_arrow_stream(body).to_pandas(split_blocks=True)
+  payload = json.loads(body)
+  # Accept both the plain split-oriented payload sent by score_model and the newer {"dataframe_split": ...} form
+  return pd.DataFrame(**payload.get('dataframe_split', payload))
+
+def encode_predictions(predictions: np.ndarray, content_type=JSON_CONTENT_TYPE) -> bytes:
+  if content_type == ARROW_CONTENT_TYPE:
+    return _write_arrow_stream(pa.table({'predictions': predictions}))
+  return json.dumps(predictions.tolist()).encode()
+
+def decode_predictions(body: bytes, content_type=JSON_CONTENT_TYPE) -> np.ndarray:
+  if content_type == ARROW_CONTENT_TYPE:
+    return _read_arrow_stream(body).column('predictions').to_numpy()
+  predictions = json.loads(body)
+  # Depending on the MLflow version, serving endpoints return either a bare list or {"predictions": [...]}
+  if isinstance(predictions, dict):
+    predictions = predictions['predictions']
+  return np.asarray(predictions)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Hosting the model locally
+# MAGIC 
+# MAGIC You can also host the registered model yourself. The following code starts a small HTTP scoring server that keeps the model in memory and accepts the same `/invocations` requests as the serving endpoint.
+# MAGIC 
+# MAGIC Under concurrent traffic, most of the cost of a small request is per-call overhead, not the model itself. The server therefore merges concurrent requests into a single `predict` call. A batch is sent to the model as soon as the next request would take it past `max_batch_size` rows, or when the oldest queued request has waited `max_wait_ms` milliseconds. A single request larger than `max_batch_size` is scored on its own.
+
+# COMMAND ----------
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# MicroBatcher collects requests from the handler threads on a queue. A single background thread drains the queue,
+# scores the merged DataFrame with one predict call, and hands each request its own slice of the predictions.
+class MicroBatcher:
+  def __init__(self, model, max_batch_size=256, max_wait_ms=5):
+    self.model = model
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000
+    self._queue = queue.Queue()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def submit(self, model_input):
+    future = Future()
+    self._queue.put((model_input, future))
+    return future
+
+  def close(self):
+    self._queue.put(None)
+    self._thread.join()
+
+  def _run(self):
+    # A request that would push a batch over max_batch_size starts the next batch instead
+    carried = None
+    while True:
+      item = carried if carried is not None else self._queue.get()
+      carried = None
+      if item is None:
+        return
+      # A single request larger than max_batch_size is still scored in one call
+      batch = [item]
+      num_rows = len(item[0])
+      deadline = time.monotonic() + self.max_wait
+      while num_rows < self.max_batch_size:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+          break
+        try:
+          item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+          break
+        if item is None:
+          self._predict(batch)
+          return
+        if num_rows + len(item[0]) > self.max_batch_size:
+          carried = item
+          break
+        batch.append(item)
+        num_rows += len(item[0])
+      self._predict(batch)
+
+  def _predict(self, batch):
+    try:
+      model_input = pd.concat([model_input for model_input, _ in batch], ignore_index=True)
+      predictions = np.asarray(self.model.predict(model_input))
+    except Exception as e:
+      if len(batch) == 1:
+        batch[0][1].set_exception(e)
+        return
+      # One malformed request fails the merged call; score each request on its own so only that request fails
+      for request in batch:
+        self._predict([request])
+      return
+    offset = 0
+    for model_input, future in batch:
+      future.set_result(predictions[offset:offset + len(model_input)])
+      offset += len(model_input)
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+  # Every response carries a Content-Length, so connections can stay open for the client's keep-alive pool
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    # Health check, so callers can wait for the server to come up
+    if self.path != '/ping':
+      self.send_error(404)
+      return
+    self._send(200, JSON_CONTENT_TYPE, b'{}')
+
+  def do_POST(self):
+    if self.path != '/invocations':
+      self.send_error(404)
+      return
+    content_type = self.headers.get('Content-Type', JSON_CONTENT_TYPE).split(';')[0].strip()
+    if content_type not in SUPPORTED_CONTENT_TYPES:
+      self._send_error_json(415, f'Unsupported content type {content_type}')
+      return
+    # Answer in Arrow only when the caller asks for it, so plain JSON clients keep working
+    response_type = ARROW_CONTENT_TYPE if ARROW_CONTENT_TYPE in self.headers.get('Accept', '') else JSON_CONTENT_TYPE
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    try:
+      model_input = decode_frame(body, content_type)
+    except Exception as e:
+      self._send_error_json(400, f'Invalid request: {e}')
+      return
+    try:
+      predictions = self.server.batcher.submit(model_input).result()
+    except Exception as e:
+      self._send_error_json(500, str(e))
+      return
+    self._send(200, response_type, encode_predictions(predictions, response_type))
+
+  def _send_error_json(self, status, message):
+    self._send(status, JSON_CONTENT_TYPE, json.dumps({'error': message}).encode())
+
+  def _send(self, status, content_type, body):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    # Keep the notebook output free of per-request access logs
+    pass
+
+# serve_model accepts any model with a predict(DataFrame) method, for example the result of mlflow.pyfunc.load_model.
+def serve_model(model, host='127.0.0.1', port=5001, max_batch_size=256, max_wait_ms=5):
+  server = ThreadingHTTPServer((host, port), ScoringRequestHandler)
+  server.daemon_threads = True
+  server.batcher = MicroBatcher(model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+def stop_model_server(server):
+  server.shutdown()
+  server.server_close()
+  server.batcher.close()
+
+# COMMAND ----------
+
+# Host the production model on this cluster's driver
+local_server = serve_model(model, port=5001, max_batch_size=256, max_wait_ms=5)
+local_url = f'http://127.0.0.1:{local_server.server_address[1]}/invocations'
+
+response = requests.post(local_url, json=X_test[:num_predictions].to_dict(orient='split'))
+pd.DataFrame({
+  "Model Prediction": model_evaluations,
+  "Locally Served Model Prediction": response.json(),
+})
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC #### Caching predictions
+# MAGIC 
+# MAGIC When the same feature vectors are requested again and again, there is no need to run the model for each of them. `CachedPredictor` puts a `PredictionCache` in front of a model from the `ModelCache`:
+# MAGIC 
+# MAGIC - Each row is keyed by a 64-bit hash of its feature values, computed for the whole batch at once with `pd.util.hash_pandas_object`.
+# MAGIC - Repeated rows within a batch are scored once. Only the rows missing from the cache are passed to the model, in a single `predict` call.
+# MAGIC - The cached hashes are kept in a `pd.Index`, so a whole batch is looked up with a single `get_indexer` call. The lock is only held for that lookup and for inserting the new predictions, not while the model runs.
+# MAGIC - Entries expire after `ttl` seconds, and the least recently used ones are evicted beyond `max_entries`. The `hits` and `misses` counters, which count distinct rows per batch, show how effective the cache is.
+# MAGIC - The row hash only covers the values, not the column names, so the columns are first put in the order of the model's input schema and cast to its types. Predictions are cached per model version and column order. When a new version is promoted, the cache is cleared on the next call.
+# MAGIC 
+# MAGIC A `CachedPredictor` has a `predict` method like any other model, so you can host it with `serve_model`. The server's micro-batching then also lets repeated rows from concurrent requests share a single prediction.
+
+# COMMAND ----------
+
+class PredictionCache:
+  def __init__(self, max_entries=100000, ttl=300):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    # Model version and column order the cached predictions belong to
+    self._scope = None
+    self._lock = threading.Lock()
+    self._reset()
+
+  def _reset(self):
+    # Parallel arrays, one entry per row hash; _index maps a hash to its position for vectorized lookups
+    self._index = pd.Index(np.empty(0, dtype=np.uint64))
+    self._predictions = np.empty(0)
+    self._expires = np.empty(0)
+    self._last_used = np.empty(0)
+
+  @staticmethod
+  def row_hashes(model_input):
+    return pd.util.hash_pandas_object(model_input, index=False).to_numpy()
+
+  def lookup(self, scope, hashes):
+    # Returns the cached predictions for the given hashes and a mask of the hashes that were found
+    now = time.monotonic()
+    with self._lock:
+      if scope != self._scope:
+        self._reset()
+        self._scope = scope
+      positions = self._index.get_indexer(hashes)
+      found = positions >= 0
+      # Expired entries count as misses and are overwritten by the next store
+      found[found] = self._expires[positions[found]] >= now
+      positions = positions[found]
+      self._last_used[positions] = now
+      cached = self._predictions[positions]
+      self.hits += len(positions)
+      self.misses += len(hashes) - len(positions)
+    predictions = np.full(len(hashes), np.nan)
+    predictions[found] = cached
+    return predictions, found
+
+  def store(self, scope, hashes, predictions):
+    # hashes must be distinct, as returned by pd.factorize
+    now = time.monotonic()
+    with self._lock:
+      # A newer version may have been seen while these predictions were computed
+      if scope != self._scope:
+        return
+      positions = self._index.get_indexer(hashes)
+      existing = positions >= 0
+      self._predictions[positions[existing]] = predictions[existing]
+      self._expires[positions[existing]] = now + self.ttl
+      self._last_used[positions[existing]] = now
+      new = ~existing
+      if new.any():
+        keys = np.concatenate([self._index.to_numpy(), hashes[new]])
+        self._predictions = np.concatenate([self._predictions, predictions[new]])
+        self._expires = np.concatenate([self._expires, np.full(int(new.sum()), now + self.ttl)])
+        self._last_used = np.concatenate([self._last_used, np.full(int(new.sum()), now)])
+        if len(keys) > self.max_entries:
+          # Keep the most recently used entries, in their current order
+          keep = np.sort(np.argsort(self._last_used, kind='stable')[-self.max_entries:])
+          keys = keys[keep]
+          self._predictions = self._predictions[keep]
+          self._expires = self._expires[keep]
+          self._last_used = self._last_used[keep]
+        self._index = pd.Index(keys)
+
+  def clear(self):
+    with self._lock:
+      self._reset()
+      self.hits = self.misses = 0
+
+class CachedPredictor:
+  def __init__(self, model_cache, name, stage='Production', cache=None):
+    self.model_cache = model_cache
+    self.name = name
+    self.stage = stage
+    self.cache = cache or PredictionCache()
+
+  def predict(self, model_input):
+    version, model = self.model_cache.get_with_version(self.name, self.stage)
+    # Hash the columns in schema order, so the same features sent in a different column order map to the same key
+    input_schema = model.metadata.get_input_schema()
+    if input_schema is not None and input_schema.has_input_names():
+      # Cast to the schema's types too: the hash depends on the dtype, and Arrow and JSON requests decode to different ones
+      model_input = model_input[input_schema.input_names()].astype(
+        dict(zip(input_schema.input_names(), input_schema.numpy_types())))
+    cache_key = (version, tuple(model_input.columns))
+    # Look up each distinct row once; codes map every row back to its distinct row
+    codes, unique_hashes = pd.factorize(self.cache.row_hashes(model_input))
+    predictions, found = self.cache.lookup(cache_key, unique_hashes)
+    if not found.all():
+      first_rows = np.unique(codes, return_index=True)[1]
+      missing = np.flatnonzero(~found)
+      predictions[missing] = np.asarray(model.predict(model_input.iloc[first_rows[missing]]), dtype=np.float64)
+      self.cache.store(cache_key, unique_hashes[missing], predictions[missing])
+    return predictions[codes]
+
+# COMMAND ----------
+
+cached_model = CachedPredictor(model_cache, model_name)
+# The second call is answered entirely from the cache
+np.testing.assert_allclose(cached_model.predict(X_test), model.predict(X_test))
+np.testing.assert_allclose(cached_model.predict(X_test), model.predict(X_test))
+print(f'Cache hits: {cached_model.cache.hits}, misses: {cached_model.cache.misses}')
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Scoring large DataFrames
+# MAGIC 
+# MAGIC `score_model` opens a new connection for every call and sends the whole DataFrame in one request, which is fine for a handful of rows but very slow for bulk scoring. `ScoringClient` keeps a pool of persistent connections, splits the input into chunks of `chunk_size` rows, sends up to `max_workers` chunks concurrently, retries failed requests with exponential backoff, and returns the predictions in the original row order.
+
+# COMMAND ----------
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+class ScoringClient:
+  # Status codes that indicate a transient failure worth retrying
+  RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+  def __init__(self, url, token=None, chunk_size=1000, max_workers=8, max_retries=3, backoff_factor=0.5, timeout=60,
+               content_type=JSON_CONTENT_TYPE):
+    self.url = url
+    self.chunk_size = chunk_size
+    self.max_workers = max_workers
+    self.max_retries = max_retries
+    self.backoff_factor = backoff_factor
+    self.timeout = timeout
+    self.content_type = content_type
+    self.session = requests.Session()
+    # Size the connection pool to match the number of concurrent requests so connections are reused, not reopened
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    if token is not None:
+      self.session.headers['Authorization'] = f'Bearer {token}'
+
+  def score(self, dataset: pd.DataFrame) -> np.ndarray:
+    chunks = [dataset.iloc[start:start + self.chunk_size] for start in range(0, len(dataset), self.chunk_size)]
+    if len(chunks) <= 1:
+      return self._post(dataset)
+    # executor.map yields results in submission order, so the predictions line up with the input rows
+    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+      return np.concatenate(list(executor.map(self._post, chunks)))
+
+  def close(self):
+    self.session.close()
+
+  def _post(self, chunk):
+    attempt = 0
+    while True:
+      content_type = self.content_type
+      headers = {'Content-Type': content_type, 'Accept': content_type}
+      try:
+        response = self.session.post(self.url, data=encode_frame(chunk, content_type), headers=headers, timeout=self.timeout)
+      except (requests.ConnectionError, requests.Timeout):
+        if attempt == self.max_retries:
+          raise
+      else:
+        if response.status_code == 200:
+          response_type = response.headers.get('Content-Type', JSON_CONTENT_TYPE).split(';')[0].strip()
+          return decode_predictions(response.content, response_type)
+        if response.status_code == 415 and content_type != JSON_CONTENT_TYPE:
+          # The endpoint does not understand Arrow (Databricks model serving, for example), so fall back to JSON
+          # for this and every later request
+          self.content_type = JSON_CONTENT_TYPE
+          continue
+        if response.status_code not in self.RETRY_STATUS_CODES or attempt == self.max_retries:
+          raise Exception(f'Request failed with status {response.status_code}, {response.text}')
+      time.sleep(self.backoff_factor * 2 ** attempt)
+      attempt += 1
+
+# COMMAND ----------
+
+# The same client works against the serving endpoint and against the local server started above
+scoring_client = ScoringClient(local_url, chunk_size=500, max_workers=8, content_type=ARROW_CONTENT_TYPE)
+# scoring_client = ScoringClient('https://DATABRICKS_URL/model/wine_quality/Production/invocations', token=os.environ.get("DATABRICKS_TOKEN"))
+
+bulk_predictions = scoring_client.score(X_test)
+print(f'AUC: {roc_auc_score(y_test, bulk_predictions)}')
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Checking served predictions against the local model
+# MAGIC 
+# MAGIC Comparing a handful of predictions by eye does not show whether the served model matches the local one on all inputs. `check_prediction_parity` sends a holdout set through both, chunk by chunk, and fails if any prediction differs by more than `atol + rtol * abs(local prediction)`, the same rule as `np.isclose`. The holdout can be a DataFrame or any iterable of DataFrames, such as batches read from a table, so it never has to fit in memory at once. While the endpoint scores a chunk, the local model scores the same chunk.
+# MAGIC 
+# MAGIC The memory used does not grow with the number of rows. Absolute and relative differences go into log-scale histograms with 20 bins per decade, so each reported quantile is the upper edge of its bin, capped at the exact maximum. Only the `top_k` rows with the largest absolute differences are kept, together with their features.
+
+# COMMAND ----------
+
+# Histogram bin edges for the differences; the first bin also collects exact matches
+PARITY_BIN_EDGES = np.concatenate([[0.0], np.logspace(-16, 4, 401)])
+
+def check_prediction_parity(holdout, remote_predict, local_predict, chunk_size=100000, atol=1e-6, rtol=1e-5, top_k=10,
+                            quantiles=(0.5, 0.9, 0.99, 0.999), raise_on_failure=True):
+  chunks = holdout
+  if isinstance(holdout, pd.DataFrame):
+    chunks = (holdout.iloc[start:start + chunk_size] for start in range(0, len(holdout), chunk_size))
+  abs_counts = np.zeros(len(PARITY_BIN_EDGES) - 1, dtype=np.int64)
+  rel_counts = np.zeros(len(PARITY_BIN_EDGES) - 1, dtype=np.int64)
+  rows = failures = 0
+  max_abs_diff = max_rel_diff = 0.0
+  worst_rows = None
+  with ThreadPoolExecutor(max_workers=1) as executor:
+    for chunk in chunks:
+      remote_future = executor.submit(remote_predict, chunk)
+      local = np.asarray(local_predict(chunk), dtype=np.float64).ravel()
+      remote = np.asarray(remote_future.result(), dtype=np.float64).ravel()
+      if len(remote) != len(chunk) or len(local) != len(chunk):
+        raise Exception(f'Expected {len(chunk)} predictions, got {len(remote)} served and {len(local)} local')
+      abs_diff = np.abs(remote - local)
+      rel_diff = abs_diff / np.maximum(np.abs(local), np.finfo(np.float64).tiny)
+      # A NaN on one side only is a mismatch; NaN on both sides is a match
+      both_nan = np.isnan(remote) & np.isnan(local)
+      abs_diff = np.where(both_nan, 0.0, np.where(np.isnan(abs_diff), np.inf, abs_diff))
+      rel_diff = np.where(both_nan, 0.0, np.where(np.isnan(rel_diff), np.inf, rel_diff))
+      failures += int(np.count_nonzero(~np.isclose(remote, local, rtol=rtol, atol=atol, equal_nan=True)))
+      rows += len(chunk)
+      max_abs_diff = max(max_abs_diff, float(abs_diff.max(initial=0.0)))
+      max_rel_diff = max(max_rel_diff, float(rel_diff.max(initial=0.0)))
+      abs_counts += np.histogram(np.clip(abs_diff, 0, PARITY_BIN_EDGES[-1]), PARITY_BIN_EDGES)[0]
+      rel_counts += np.histogram(np.clip(rel_diff, 0, PARITY_BIN_EDGES[-1]), PARITY_BIN_EDGES)[0]
+      # Carry forward only this chunk's top_k candidates
+      candidates = np.argpartition(-abs_diff, min(top_k, len(abs_diff)) - 1)[:top_k] if len(abs_diff) else []
+      chunk_worst = chunk.iloc[candidates].assign(served_prediction=remote[candidates], local_prediction=local[candidates],
+                                                  abs_diff=abs_diff[candidates], rel_diff=rel_diff[candidates])
+      worst_rows = pd.concat([worst_rows, chunk_worst]).nlargest(top_k, 'abs_diff') if worst_rows is not None else chunk_worst
+
+  def histogram_quantile(counts, q, maximum):
+    # The upper bin edge can lie above every observed difference, so never report more than the maximum
+    return min(PARITY_BIN_EDGES[1:][np.searchsorted(np.cumsum(counts), q * counts.sum())], maximum) if counts.sum() else 0.0
+
+  summary = pd.DataFrame({
+    'abs_diff': [histogram_quantile(abs_counts, q, max_abs_diff) for q in quantiles] + [max_abs_diff],
+    'rel_diff': [histogram_quantile(rel_counts, q, max_rel_diff) for q in quantiles] + [max_rel_diff],
+  }, index=[f'p{q * 100:g}' for q in quantiles] + ['max'])
+  report = {'rows': rows, 'failures': failures, 'quantiles': summary,
+            'worst_rows': worst_rows.sort_values('abs_diff', ascending=False) if worst_rows is not None else None}
+  if failures and raise_on_failure:
+    raise Exception(f'{failures} of {rows} served predictions differ from the local model by more than '
+                    f'atol={atol}, rtol={rtol}. Largest absolute difference: {max_abs_diff}')
+  return report
+
+# COMMAND ----------
+
+parity = check_prediction_parity(X_test, scoring_client.score, model.predict, chunk_size=1000)
+print(f"{parity['rows']} rows checked, {parity['failures']} over tolerance")
+display(parity['quantiles'])
+display(parity['worst_rows'])
+
+# COMMAND ----------
+
+# Shut down the client and the local server when you are done with them
+scoring_client.close()
+stop_model_server(local_server)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Benchmarking inference paths
+# MAGIC 
+# MAGIC This notebook shows several ways to score the model: calling `model.predict` locally, applying it to a Delta table with `spark_udf` or `mapInPandas`, and sending requests to a serving endpoint. Which one is fastest depends on the number of rows and the batch size. `run_inference_benchmarks` runs each path against synthetic wine-shaped data at several row counts and batch sizes and reports, for each combination:
+# MAGIC 
+# MAGIC - throughput in rows per second
+# MAGIC - p50, p95 and p99 latency per call. For the Spark paths, a call is a whole job.
+# MAGIC - peak Python memory of the in-process paths, measured with `tracemalloc` in a separate untimed pass
+# MAGIC 
+# MAGIC The served paths use the local scoring server as a stand-in for the endpoint. They send one request at a time, so the server is started with `max_wait_ms=0`: otherwise every call would also include the micro-batcher's wait for more requests that never arrive. The synthetic data is drawn from a fixed seed, so reruns score the same rows. Results are appended as JSON lines to `output_path`, together with the library versions and machine details, so runs can be compared. Outside Databricks, run the same code on a local-mode session, `SparkSession.builder.master("local[*]")`.
+
+# COMMAND ----------
+
+import datetime
+import platform
+import tracemalloc
+import sklearn
+from pyspark.sql.functions import struct
+
+def make_synthetic_wine(n_rows, reference, seed=123):
+  # Draw the measurements from a multivariate normal fitted to the reference data, clipped to its observed range
+  rng = np.random.default_rng(seed)
+  features = reference.drop(columns=['is_red'])
+  values = rng.multivariate_normal(features.mean().to_numpy(), features.cov().to_numpy(), size=n_rows)
+  values = np.clip(values, features.min().to_numpy(), features.max().to_numpy())
+  synthetic = pd.DataFrame(values, columns=features.columns).astype(features.dtypes.to_dict())
+  synthetic['is_red'] = (rng.random(n_rows) < reference.is_red.mean()).astype(reference.is_red.dtype)
+  return synthetic[reference.columns]
+
+def _time_batches(score_batch, dataset, batch_size):
+  latencies = []
+  start = time.perf_counter()
+  for offset in range(0, len(dataset), batch_size):
+    call_start = time.perf_counter()
+    score_batch(dataset.iloc[offset:offset + batch_size])
+    latencies.append(time.perf_counter() - call_start)
+  return latencies, time.perf_counter() - start
+
+def _peak_python_memory(run):
+  tracemalloc.start()
+  try:
+    run()
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+def _benchmark_environment():
+  return {
+    'timestamp': datetime.datetime.utcnow().isoformat(),
+    'python': platform.python_version(),
+    'machine': platform.machine(),
+    'cpu_count': os.cpu_count(),
+    'mlflow': mlflow.__version__,
+    'sklearn': sklearn.__version__,
+    'xgboost': xgb.__version__,
+    'spark': spark.version,
+  }
+
+# batch_paths map a name to a function that scores one pandas batch in this process.
+# spark_paths map a name to a function (table_path, batch_size) that runs one complete Spark scoring job.
+def run_inference_benchmarks(batch_paths, spark_paths, row_counts, batch_sizes, reference, table_root,
+                             repeats=3, output_path=None, seed=123):
+  environment = _benchmark_environment()
+  results = []
+  for n_rows in row_counts:
+    dataset = make_synthetic_wine(n_rows, reference, seed=seed)
+    table_path = f'{table_root}/rows={n_rows}'
+    if spark_paths:
+      spark.createDataFrame(dataset).write.format('delta').mode('overwrite').save(table_path)
+    for batch_size in batch_sizes:
+      for name, score_batch in batch_paths.items():
+        # Warm up connections and caches, then measure memory and time in separate passes
+        score_batch(dataset.iloc[:batch_size])
+        peak_bytes = _peak_python_memory(lambda: _time_batches(score_batch, dataset, batch_size))
+        latencies, total_seconds = [], 0.0
+        for _ in range(repeats):
+          run_latencies, run_seconds = _time_batches(score_batch, dataset, batch_size)
+          latencies += run_latencies
+          total_seconds += run_seconds
+        results.append(_benchmark_result(name, n_rows, batch_size, latencies, n_rows * repeats / total_seconds, peak_bytes))
+      for name, run_job in spark_paths.items():
+        run_job(table_path, batch_size)
+        latencies = []
+        for _ in range(repeats):
+          start = time.perf_counter()
+          run_job(table_path, batch_size)
+          latencies.append(time.perf_counter() - start)
+        # The work happens on the executors, so driver-side Python memory says nothing about these paths
+        results.append(_benchmark_result(name, n_rows, batch_size, latencies, n_rows * repeats / sum(latencies), None))
+  results = [{**environment, **result} for result in results]
+  if output_path is not None:
+    with open(output_path, 'a') as f:
+      for result in results:
+        f.write(json.dumps(result) + '\n')
+  return pd.DataFrame(results)
+
+def _benchmark_result(path, n_rows, batch_size, latencies, throughput, peak_bytes):
+  latencies_ms = np.asarray(latencies) * 1000
+  return {
+    'path': path,
+    'rows': n_rows,
+    'batch_size': batch_size,
+    'calls': len(latencies_ms),
+    'throughput_rows_per_s': throughput,
+    'latency_p50_ms': float(np.percentile(latencies_ms, 50)),
+    'latency_p95_ms': float(np.percentile(latencies_ms, 95)),
+    'latency_p99_ms': float(np.percentile(latencies_ms, 99)),
+    'peak_python_memory_bytes': peak_bytes,
+  }
+
+# COMMAND ----------
+
+# Pin the model version so every path scores the same model
+benchmark_model_uri = f"models:/{model_name}/{model_cache.version(model_name)}"
+benchmark_model = model_cache.get(model_name)
+# The clients send one request at a time, so no second request could ever join a batch.
+# max_wait_ms=0 sends each request to the model at once instead of waiting for a batch to fill.
+benchmark_server = serve_model(benchmark_model, port=5002, max_wait_ms=0)
+benchmark_url = f'http://127.0.0.1:{benchmark_server.server_address[1]}/invocations'
+# A chunk size above the largest batch size sends each batch as a single request
+json_client = ScoringClient(benchmark_url, chunk_size=100000, content_type=JSON_CONTENT_TYPE)
+arrow_client = ScoringClient(benchmark_url, chunk_size=100000, content_type=ARROW_CONTENT_TYPE)
+benchmark_udf = mlflow.pyfunc.spark_udf(spark, benchmark_model_uri)
+
+def spark_udf_job(table_path, batch_size):
+  scored = spark.read.format('delta').load(table_path).withColumn('prediction', benchmark_udf(struct(*X_train.columns)))
+  # The noop sink runs the whole job without writing anything
+  with arrow_records_per_batch(spark, batch_size):
+    scored.write.format('noop').mode('overwrite').save()
+
+def map_in_pandas_job(table_path, batch_size):
+  scored = predict_with_map_in_pandas(spark.read.format('delta').load(table_path), benchmark_model_uri, X_train.columns)
+  with arrow_records_per_batch(spark, batch_size):
+    scored.write.format('noop').mode('overwrite').save()
+
+benchmark_results = run_inference_benchmarks(
+  batch_paths={
+    'local_predict': benchmark_model.predict,
+    'served_json': json_client.score,
+    'served_arrow': arrow_client.score,
+  },
+  spark_paths={
+    'spark_udf': spark_udf_job,
+    'map_in_pandas': map_in_pandas_job,
+  },
+  row_counts=[1000, 100000],
+  batch_sizes=[10, 1000, 10000],
+  reference=X_train,
+  # Replace <username> with your username before running this cell.
+  table_root="/user/<username>/delta/wine_benchmark",
+  output_path="/dbfs/tmp/wine_inference_benchmarks.jsonl",
+)
+display(benchmark_results)
+
+# COMMAND ----------
+
+json_client.close()
+arrow_client.close()
+stop_model_server(benchmark_server)